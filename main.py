@@ -1,8 +1,12 @@
 import argparse
 
-from modules.calibration import initial_calibration, second_calibration
+from modules.calibration import initial_calibration, second_calibration, ssvi_calibration
 from modules.dataRetrieval import retrieve_data_live, retrieve_data_source
 from modules.calc_svi import test_calc_svi
+from modules.dataRetrieval import retrieve_initial_svi_param_dict
+from modules.surfaceTable import publish_surface
+from modules.formulas import set_backend
+from modules.pipeline import pipelined_calibration
 
 
 def restricted_float(x):
@@ -19,12 +23,26 @@ def restricted_float(x):
 # initial calibration mode from live data
 # -m initial -s deribit -bsthres 0.1
 
+# initial calibration mode from a local Deribit stand-in (python -m modules.DeribitAPI.deribit_standin -t 20220416_143702)
+# -m initial -s deribit --uri http://127.0.0.1:8765/api/v2/public/ -bsthres 0.1
+
+# initial calibration mode from live data, calibrating while later expiries are still downloading
+# -m initial -s deribit -p -bsthres 0.1
+
 # initial calibration mode from live data
 # -m initial -s stored -t 20220416_143702 -bsthres 0.1
 
+# initial calibration mode, one arbitrage-free SSVI surface for all maturities
+# -m initial -s stored -t 20220416_143702 -bsthres 0.1 -e ssvi
+
 # re-calibration mode
 # -m recal -s stored -t 20220416_143702 -bsthres 0.1
 
+# export mode, publish the calibrated surface as a shared memory-mapped lookup table (modules/surfaceTable.py),
+# replacing the table even if it holds a newer snapshot
+# -m export -s stored -t 20220416_143702
+# -m export -s stored -t 20220416_143702 -e ssvi
+
 # calc mode
 # -m calconly -s stored -t 20220416_143702 -bsthres 0.1
 
@@ -32,19 +50,50 @@ def restricted_float(x):
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument("-m", "--mode", type=str, required=True,
-                        help="'initial' for initial calibration, 'recal' for further calibration (eliminate arbitrage), 'calconly' for calculation svi only")
+                        help="'initial' for initial calibration, 'recal' for further calibration (eliminate arbitrage), 'calconly' for calculation svi only, 'export' to publish the shared surface table")
     parser.add_argument("-s", "--source", type=str, required=True,
                         help="'deribit' or 'live' for live data, 'stored' for stored data")
     parser.add_argument("-bsthres", type=restricted_float,
                         help="bs delta cutoff threshold, default is 0.1")
     parser.add_argument("-t", "--timestamp", type=str,
                         help="timestamp for static option and future input, in yyyymmdd_hhmmss, store in the folder with string equals the local time")
+    parser.add_argument("-e", "--engine", type=str, default='raw',
+                        help="'raw' to fit each maturity with raw SVI, 'ssvi' to fit one SSVI surface to all maturities jointly")
+    parser.add_argument("--backend", type=str,
+                        help="kernel backend, 'numpy' (default) or 'numba', also set by the SVI_BACKEND environment variable")
+    parser.add_argument("-p", "--pipelined", action='store_true',
+                        help="initial calibration from live data only: calibrate each maturity while later expiries are still downloading")
+    parser.add_argument("--uri", type=str,
+                        help="Deribit public API endpoint for live data, e.g. a local stand-in http://127.0.0.1:8765/api/v2/public/")
 
     args = parser.parse_args()
 
+    if args.backend:
+        set_backend(args.backend.lower())
+
+    bs_delta_threshold = 0.1  # default BS threshold value
+    if args.bsthres:
+        bs_delta_threshold = args.bsthres
+
+    # stage 0 and 1 overlapped - download, clean and calibrate expiry by expiry
+    if args.pipelined:
+        if args.mode.lower() != 'initial' or args.source.lower() not in ['deribit', 'live']:
+            raise ValueError('--pipelined only applies to initial calibration from live data')
+        if args.engine.lower() != 'raw':
+            raise ValueError('--pipelined calibrates maturity by maturity, it only supports the raw engine')
+        if args.uri:
+            pipelined_calibration(bs_delta_threshold=bs_delta_threshold, uri=args.uri)
+        else:
+            pipelined_calibration(bs_delta_threshold=bs_delta_threshold)
+        raise SystemExit(0)
+
     # stage 0 - retrieve data (from deribit or previously stored data)
-    if args.source.lower() in ['deribit', 'live']:
-        datetime, options_df, futures_df = retrieve_data_live()
+    live = args.source.lower() in ['deribit', 'live']  # only live captures replace the shared surface table
+    if live:
+        if args.uri:
+            datetime, options_df, futures_df = retrieve_data_live(uri=args.uri)
+        else:
+            datetime, options_df, futures_df = retrieve_data_live()
         localtimestamp = datetime
     elif args.source.lower() in ['stored']:
         localtimestamp = args.timestamp
@@ -52,18 +101,21 @@ if __name__ == '__main__':
     else:
         raise ValueError(f'Unknown source: {args.source}')
 
-    bs_delta_threshold = 0.1  # default BS threshold value
-    if args.bsthres:
-        bs_delta_threshold = args.bsthres
-
     # stage 1 - from the data received calibrate the model
 
-    if args.mode.lower() == 'initial':
-        initial_calibration(timestamp=localtimestamp, options_df=options_df, bs_delta_threshold=bs_delta_threshold)
+    if args.mode.lower() == 'initial' and args.engine.lower() == 'ssvi':
+        ssvi_calibration(timestamp=localtimestamp, options_df=options_df, bs_delta_threshold=bs_delta_threshold,
+                         publish=live)
+    elif args.mode.lower() == 'initial':
+        initial_calibration(timestamp=localtimestamp, options_df=options_df, bs_delta_threshold=bs_delta_threshold,
+                            publish=live)
     elif args.mode.lower() == 'recal':
         second_calibration(timestamp=localtimestamp, options_df=options_df, bs_delta_threshold=bs_delta_threshold)
     elif args.mode.lower() == 'calconly':
         test_calc_svi(t_mat=0.0027888, strike=90000, localtimestamp=localtimestamp, options_df=options_df,
                       futures_df=futures_df)
+    elif args.mode.lower() == 'export':
+        publish_surface(retrieve_initial_svi_param_dict(localtimestamp, engine=args.engine.lower()), localtimestamp,
+                        force=True)
     else:
         raise ValueError(f'Unknown mode: {args.mode}')
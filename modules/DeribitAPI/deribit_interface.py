@@ -4,13 +4,19 @@ import pandas as pd
 import requests
 import datetime
 import json
+import time
 
-uri = 'https://www.deribit.com/api/v2/public/'
+from modules.persistence import save_snapshot
+
+# point at a local stand-in (see deribit_standin.py) with DERIBIT_URI=http://127.0.0.1:8765/api/v2/public/
+uri = os.environ.get('DERIBIT_URI', 'https://www.deribit.com/api/v2/public/')
+max_retries = 3  # retries on rate limit (429), server errors and timeouts, with exponential backoff
+request_timeout = (5, 30)  # seconds to connect, seconds to wait for the response
 credentials_fname = 'credentials.json'
 spec_fname = 'input_call_sept_24.json'
 
 
-def authenticate(fname):
+def authenticate(fname, uri=uri):
     """
         API authentication with credentials stored in fname (.json)
     """
@@ -18,8 +24,9 @@ def authenticate(fname):
         credentials = json.loads(f.read())
 
     _ = requests.get(
-        'https://www.deribit.com/api/v2/public/auth',
-        {"grant_type": "client_credentials", **credentials}
+        uri + 'auth',
+        {"grant_type": "client_credentials", **credentials},
+        timeout=request_timeout
     )
 
 
@@ -59,7 +66,29 @@ def call_api(uri, method, params):
         method (str): Deribit method name
         params (dict): Parameters for the API call
     """
-    return requests.get(uri + method, params).json()['result']
+    for attempt in range(max_retries + 1):
+        try:
+            response = requests.get(uri + method, params, timeout=request_timeout)
+        except requests.Timeout:
+            if attempt == max_retries:
+                raise
+        else:
+            if response.status_code != 429 and response.status_code < 500:
+                break
+        if attempt < max_retries:
+            time.sleep(0.1 * 2 ** attempt)
+
+    try:
+        body = response.json()
+    except ValueError:
+        body = {}
+    if 'result' not in body:
+        # Deribit error bodies are {"error": {"code": ..., "message": ...}}
+        error = body.get('error', {})
+        raise requests.HTTPError(f"{method} failed with HTTP {response.status_code}: "
+                                 f"{error.get('message', response.reason)} (code {error.get('code')})",
+                                 response=response)
+    return body['result']
 
 
 def filter_options(option_type, options, spot):
@@ -215,10 +244,11 @@ def get_options_data(uri, currency, option_type, spot):
     return options_data
 
 
-def get_deribit_data():
+def get_deribit_data(uri=uri):
     snap_dt_str = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")  # local time
+    capture_start = time.perf_counter()
     # authenticate with credentials
-    authenticate(credentials_fname)
+    authenticate(credentials_fname, uri=uri)
     # get option specification
     specification = get_option_specification(filename=spec_fname)
 
@@ -235,27 +265,65 @@ def get_deribit_data():
         option_type=specification['type'],
         spot=currency_price
     )
-    folder_path = f"{snap_dt_str}"
-    if not os.path.exists(folder_path):
-        os.makedirs(folder_path)
+    utc_t0 = datetime.datetime.utcnow()  # POSIX unit time
 
+    # the archive keeps Spot and utc_T0 once, the returned frames get them as (broadcast) columns
+    save_snapshot(snap_dt_str, specification['currency'], currency_price, utc_t0, future_price, options_data)
     futures_df = pd.DataFrame(future_price)
+    futures_df['Spot'] = currency_price
+    futures_df['utc_T0'] = utc_t0
     option_df = pd.DataFrame(options_data)
-    utc_t0 = datetime.datetime.utcnow()  # POSIX unit time
-
-    curr_vec = pd.DataFrame(np.full(shape=futures_df.shape[0], fill_value=currency_price))
-    utc_t0_vec = pd.DataFrame(np.full(shape=futures_df.shape[0], fill_value=utc_t0))
-    aux_pd = pd.concat([curr_vec.rename(columns={0: 'Spot'}), utc_t0_vec.rename(columns={0: 'utc_T0'})], axis=1)
-    futures_df = pd.concat([futures_df, aux_pd], axis=1)
-    futures_df.to_csv(os.path.join(folder_path, f"Futures.csv"))
-
-    curr_vec = pd.DataFrame(np.full(shape=option_df.shape[0], fill_value=currency_price))
-    utc_t0_vec = pd.DataFrame(np.full(shape=option_df.shape[0], fill_value=utc_t0))
-    aux_pd = pd.concat([curr_vec.rename(columns={0: 'Spot'}), utc_t0_vec.rename(columns={0: 'utc_T0'})], axis=1)
-    option_df = pd.concat([option_df, aux_pd], axis=1)
-    option_df.to_csv(os.path.join(folder_path, f"Options.csv"))
-    print(f"Finishes fetching and saving Deribit data for local datetime: f{snap_dt_str}")
+    option_df['Spot'] = currency_price
+    option_df['utc_T0'] = utc_t0
+    capture_seconds = time.perf_counter() - capture_start
+    print(f"Finishes fetching Deribit data for local datetime: {snap_dt_str}, saving in the background")
+    print(f"Snapshot capture took {capture_seconds:.3f}s against {uri}")
     ret = {'dateTime': snap_dt_str,
+           'captureSeconds': capture_seconds,
            'futures': futures_df,
            'options': option_df}
     return ret
+
+
+def stream_deribit_data(uri=uri):
+    """
+    Generator version of get_deribit_data for pipelined capture, nothing is written to disk
+
+    Yields first a dictionary with the snapshot header (dateTime, currency, spot, utc_T0) and the futures
+    DataFrame, then one options DataFrame per expiry (earliest first) as soon as its IVs are downloaded.
+
+    Arguments:
+        uri (str): Endpoint for the API calls
+    """
+    snap_dt_str = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")  # local time
+    authenticate(credentials_fname, uri=uri)
+    specification = get_option_specification(filename=spec_fname)
+    currency = specification['currency']
+
+    currency_price = get_currency_price(uri, currency)
+    utc_t0 = datetime.datetime.utcnow()  # POSIX unit time
+
+    futures_df = pd.DataFrame(get_future_data(uri=uri, currency=currency))
+    futures_df['Spot'] = currency_price
+    futures_df['utc_T0'] = utc_t0
+    yield {'dateTime': snap_dt_str,
+           'currency': currency,
+           'spot': currency_price,
+           'utc_T0': utc_t0,
+           'futures': futures_df}
+
+    print('Streaming data for all {} options by expiry'.format(currency))
+    instr_args = {'currency': currency, 'kind': 'option', 'expired': 'false'}
+    options = call_api(uri, 'get_instruments', instr_args)
+    options = filter_all_options(options=options, spot=currency_price)
+    for expiration_timestamp in sorted(set(map(lambda i: i['expiration_timestamp'], options))):
+        expiry_options = list(filter(lambda i: i['expiration_timestamp'] == expiration_timestamp, options))
+        option_df = pd.DataFrame({
+            'type': list(map(lambda i: i['option_type'], expiry_options)),
+            'strikes': np.array(list(map(lambda i: i['strike'], expiry_options))),
+            'maturities': np.full(len(expiry_options), expiration_timestamp / 1000),
+            'implied_volatilities': get_implied_volatilities(options=expiry_options, uri=uri),
+        })
+        option_df['Spot'] = currency_price
+        option_df['utc_T0'] = utc_t0
+        yield option_df
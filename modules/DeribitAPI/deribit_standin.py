@@ -0,0 +1,198 @@
+import argparse
+import datetime
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+from dateutil.relativedelta import relativedelta
+
+from modules.persistence import read_snapshot
+
+# Local stand-in for the public Deribit API, serving an archived snapshot folder.
+# Start it with
+#   python -m modules.DeribitAPI.deribit_standin -t 20220416_143702 --latency 0.05 --jitter 0.02 --rate 20
+# and capture against it with
+#   python main.py -m initial -s deribit --uri http://127.0.0.1:8765/api/v2/public/
+# authenticate() still reads credentials.json, any {"client_id": "...", "client_secret": "..."} will do.
+
+api_prefix = '/api/v2/public/'
+month_codes = ['JAN', 'FEB', 'MAR', 'APR', 'MAY', 'JUN', 'JUL', 'AUG', 'SEP', 'OCT', 'NOV', 'DEC']
+
+
+def expiry_code(expiration_timestamp_ms):
+    # Deribit style expiry code, e.g. 16APR22
+    T = datetime.datetime.fromtimestamp(expiration_timestamp_ms / 1000, tz=datetime.timezone.utc)
+    return f'{T.day}{month_codes[T.month - 1]}{T.strftime("%y")}'
+
+
+def shift_expiry(expiration_timestamp_ms, months):
+    # whole calendar months, day of month and time of day are kept (clamped to the last day of shorter months)
+    T = datetime.datetime.fromtimestamp(expiration_timestamp_ms / 1000, tz=datetime.timezone.utc)
+    return int((T + relativedelta(months=months)).timestamp() * 1000)
+
+
+def load_snapshot(folder, currency):
+    """
+    Returns the instruments, order books and index price of an archived snapshot folder
+
+    Expiries are moved forward by the whole number of calendar months that brings the archived capture time level
+    with or just past now, so every expiry is still in the future. Day of month and time of day are kept, so the
+    30/360 day counts between expiries are those of the original snapshot, and the times to maturity are the
+    archived ones when the stand-in is queried on the day of month and at the time of day of the capture (longer
+    by up to a month otherwise). Dated futures are renamed after their shifted expiry, BTC-PERPETUAL is kept.
+
+    Arguments:
+        folder (str): Snapshot folder containing snapshot.npz, or Options.csv and Futures.csv
+        currency (string): Cryptocurrency the snapshot was captured for
+    """
+    futures, options = read_snapshot(folder)
+    spot = float(options.Spot.iloc[0])
+    # utc_T0 is the archived capture time in UTC, '%Y-%m-%d %H:%M:%S.%f'
+    archived_t0 = datetime.datetime.strptime(str(options.utc_T0.iloc[0]), '%Y-%m-%d %H:%M:%S.%f')
+    now = datetime.datetime.utcnow()
+    months = (now.year - archived_t0.year) * 12 + now.month - archived_t0.month
+    if archived_t0 + relativedelta(months=months) < now:
+        months += 1
+
+    instruments = {'option': [], 'future': []}
+    books = {}
+    for row in futures.itertuples():
+        expiration_timestamp = shift_expiry(int(row.maturities), months)
+        name = row.instrument_names
+        if not name.endswith('PERPETUAL'):
+            name = f'{currency}-{expiry_code(expiration_timestamp)}'
+        instruments['future'].append({
+            'instrument_name': name,
+            'kind': 'future',
+            'expiration_timestamp': expiration_timestamp,
+            'base_currency': currency,
+        })
+        books[name] = {
+            'instrument_name': name,
+            'last_price': row.last_price,
+            'mark_price': row.mark_price,
+            'index_price': row.index_price,
+        }
+    for row in options.itertuples():
+        expiration_timestamp = shift_expiry(int(round(row.maturities * 1000)), months)
+        name = f'{currency}-{expiry_code(expiration_timestamp)}-{int(row.strikes)}-{row.type[0].upper()}'
+        instruments['option'].append({
+            'instrument_name': name,
+            'kind': 'option',
+            'option_type': row.type,
+            'strike': row.strikes,
+            'expiration_timestamp': expiration_timestamp,
+            'base_currency': currency,
+        })
+        books[name] = {
+            'instrument_name': name,
+            'mark_iv': row.implied_volatilities * 100,  # Deribit quotes IV in percent
+            'index_price': spot,
+            'underlying_price': spot,
+        }
+    return instruments, books, spot
+
+
+def make_handler(folder, currency, latency=0.0, jitter=0.0, rate=None, failure_rate=0.0):
+    """
+    Returns a request handler class serving the snapshot in folder
+
+    Arguments:
+        folder (str): Snapshot folder containing snapshot.npz, or Options.csv and Futures.csv
+        currency (string): Cryptocurrency the snapshot was captured for
+        latency (float): Fixed delay added to every request, in seconds
+        jitter (float): Uniformly distributed extra delay in [0, jitter], in seconds
+        rate (float): Requests per second allowed before answering 429 too_many_requests, unlimited when None
+        failure_rate (float): Probability of answering 500 internal_server_error
+    """
+    instruments, books, spot = load_snapshot(folder, currency)
+    bucket = {'tokens': rate or 0.0, 'last': time.monotonic()}
+    lock = threading.Lock()
+
+    def take_token():
+        # token bucket refilled at `rate` per second, holds at most one second worth of requests
+        if rate is None:
+            return True
+        with lock:
+            now = time.monotonic()
+            bucket['tokens'] = min(rate, bucket['tokens'] + (now - bucket['last']) * rate)
+            bucket['last'] = now
+            if bucket['tokens'] < 1:
+                return False
+            bucket['tokens'] -= 1
+            return True
+
+    def dispatch(method, params):
+        if method == 'auth':
+            return {'access_token': 'standin', 'token_type': 'bearer', 'expires_in': 900}
+        if method == 'get_index_price':
+            return {'index_price': spot, 'estimated_delivery_price': spot}
+        if method == 'get_instruments':
+            return instruments.get(params.get('kind', 'option'), [])
+        if method == 'get_order_book':
+            return books[params['instrument_name']]
+        if method == 'get_book_summary_by_currency':
+            kind = params.get('kind')
+            names = [i['instrument_name'] for k in instruments if kind in (None, k) for i in instruments[k]]
+            return [books[name] for name in names]
+        raise KeyError(method)
+
+    class StandinHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            time.sleep(latency + random.uniform(0, jitter))
+            url = urlparse(self.path)
+            method = url.path[len(api_prefix):] if url.path.startswith(api_prefix) else None
+            params = {k: v[0] for k, v in parse_qs(url.query).items()}
+
+            if not take_token():
+                self.reply(429, {'error': {'code': 10028, 'message': 'too_many_requests'}})
+            elif random.random() < failure_rate:
+                self.reply(500, {'error': {'code': 11094, 'message': 'internal_server_error'}})
+            else:
+                try:
+                    self.reply(200, {'jsonrpc': '2.0', 'result': dispatch(method, params)})
+                except KeyError as e:
+                    self.reply(400, {'error': {'code': -32602, 'message': f'invalid params: {e}'}})
+
+        def reply(self, status, payload):
+            body = json.dumps(payload).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return StandinHandler
+
+
+def serve(folder, currency='BTC', host='127.0.0.1', port=8765, **handler_kwargs):
+    server = ThreadingHTTPServer((host, port), make_handler(folder, currency, **handler_kwargs))
+    print(f'Serving {folder} as http://{host}:{port}{api_prefix}')
+    return server
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-t", "--timestamp", type=str, required=True,
+                        help="snapshot folder to replay, in yyyymmdd_hhmmss")
+    parser.add_argument("-c", "--currency", type=str, default='BTC')
+    parser.add_argument("--host", type=str, default='127.0.0.1')
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.0, help="fixed delay per request in seconds")
+    parser.add_argument("--jitter", type=float, default=0.0, help="extra uniform delay per request in seconds")
+    parser.add_argument("--rate", type=float, help="requests per second before answering 429")
+    parser.add_argument("--failure", type=float, default=0.0, help="probability of answering 500")
+    args = parser.parse_args()
+
+    server = serve(args.timestamp, currency=args.currency, host=args.host, port=args.port,
+                   latency=args.latency, jitter=args.jitter, rate=args.rate, failure_rate=args.failure)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
@@ -0,0 +1,104 @@
+import os
+import json
+import hashlib
+import numpy as np
+
+from modules.formulas import calibrate
+from modules.recovery import recover_calibration
+from modules.persistence import run_behind, write_file
+
+cache_dir = 'calib_cache'
+cache_max_bytes = 32 * 1024 * 1024  # least recently used entries are evicted above this size
+SOLVER_VERSION = '2'  # bump whenever calibrate() changes, old entries then simply stop matching
+
+cache_stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+cache_state = {'bytes': None}  # running size of the cache folder, None until the first scan
+
+
+def slice_key(moneyness, implied_vol, tau, bs_delta_threshold):
+    """
+    Returns the content hash identifying a slice calibration
+
+    Arguments:
+        moneyness, implied_vol, tau (array like): Columns of the (unfiltered) slice, sorted by strike
+        bs_delta_threshold (float): BS delta cutoff applied before calibrating
+    """
+    h = hashlib.sha256()
+    for column in [moneyness, implied_vol, tau]:
+        h.update(np.ascontiguousarray(column, dtype=np.float64).tobytes())
+        h.update(b'|')
+    h.update(repr(float(bs_delta_threshold)).encode())
+    h.update(SOLVER_VERSION.encode())
+    return h.hexdigest()
+
+
+def cache_path(key):
+    return os.path.join(cache_dir, f'{key}.json')
+
+
+def cache_get(key):
+    path = cache_path(key)
+    try:
+        with open(path, 'r') as f:
+            entry = json.load(f)
+    except (FileNotFoundError, ValueError):
+        cache_stats['misses'] += 1
+        return None
+    os.utime(path)  # mtime is the recency used for eviction
+    cache_stats['hits'] += 1
+    return entry
+
+
+def cache_put(key, entry):
+    # a miss does not wait for the disk, the entry is written (and the cache trimmed) by the background writer
+    run_behind(store_entry, cache_path(key), json.dumps(entry).encode())
+
+
+def store_entry(path, data):
+    write_file(path, data)
+    # the folder is only scanned once per process and again when the running size goes over the limit
+    size = cache_state['bytes']
+    if size is not None and size + len(data) <= cache_max_bytes:
+        cache_state['bytes'] = size + len(data)
+    else:
+        cache_state['bytes'] = evict()
+
+
+def evict(max_bytes=None):
+    # returns the size of the cache folder after eviction
+    max_bytes = cache_max_bytes if max_bytes is None else max_bytes
+    entries = [e for e in os.scandir(cache_dir) if e.name.endswith('.json')]
+    total = sum(e.stat().st_size for e in entries)
+    if total <= max_bytes:
+        return total
+    for e in sorted(entries, key=lambda e: e.stat().st_mtime):
+        total -= e.stat().st_size
+        os.remove(e.path)
+        cache_stats['evictions'] += 1
+        if total <= max_bytes:
+            break
+    return total
+
+
+def cached_calibrate(curve, bs_delta_threshold):
+    """
+    Calibrates a slice, reusing a previous result when the same slice was already calibrated,
+    slices calibrate() fails on go through recover_calibration
+
+    Arguments:
+        curve (DataFrame): Slice with MONEYNESS, IMPLIEDVOL, tau and BSDELTA columns, sorted by strike
+        bs_delta_threshold (float): Options with BS delta below the threshold are left out of the fit
+    """
+    key = slice_key(curve.MONEYNESS, curve.IMPLIEDVOL, curve.tau, bs_delta_threshold)
+    entry = cache_get(key)
+    if entry is None:
+        try:
+            A, P, B, S, M, stats = calibrate(curve[curve.BSDELTA > bs_delta_threshold], return_stats=True)
+            stats["strategy"] = "primary"
+        except (AssertionError, ValueError, np.linalg.LinAlgError):
+            print(f'calibrate failed for t={curve.tau.max()}, trying recovery')
+            A, P, B, S, M, stats = recover_calibration(curve, bs_delta_threshold)
+            print(f'recovered t={curve.tau.max()} with strategy {stats["strategy"]}')
+        entry = {"A": A, "P": P, "B": B, "S": S, "M": M, "stats": stats}
+        cache_put(key, entry)
+    return entry["A"], entry["P"], entry["B"], entry["S"], entry["M"], entry["stats"]
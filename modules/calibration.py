@@ -1,45 +1,121 @@
+import io
 import json
 import numpy as np
-import scipy as sp
 from matplotlib import pyplot as plt
-from modules.formulas import bsdelta, calibrate, calculate_svi_vol
-from modules.dataRetrieval import retrieve_initial_svi_param_dict, retrieve_calibration_hyperparameters
+from modules.formulas import bsdelta, calculate_svi_vol
+from modules.dataRetrieval import retrieve_initial_svi_param_dict, retrieve_calibration_hyperparameters, param_fnames
+from modules.paramStore import append_calibration, is_snapshot
+from modules.calibCache import cached_calibrate, cache_stats
+from modules.ssvi import calibrate_ssvi, ssvi_to_raw
+from modules.surfaceTable import publish_surface
+from modules.jointRefit import joint_refit
+from modules.persistence import write_behind, run_behind
 
 
-def initial_calibration(timestamp, options_df, bs_delta_threshold=0.1):
+def initial_calibration(timestamp, options_df, bs_delta_threshold=0.1, currency='BTC', publish=False):
     # the FUTURE PRICE should be interpolated from the futures csv
     options_df['MONEYNESS'] = np.log(options_df.STRIKE / options_df.FUTUREPRICE)
     options_df['BSDELTA'] = options_df.apply(lambda x: bsdelta(x.MONEYNESS, x.IMPLIEDVOL, x.tau, x.type), axis=1)
 
     svi_param = {}
+    svi_stats = {}
     mat_vec = options_df.tau.unique()
 
     for i in range(len(mat_vec)):
-        try:
-            curve = options_df[options_df.tau == mat_vec[i]].sort_values('STRIKE')
-            curve = curve[['MONEYNESS', 'IMPLIEDVOL', 'tau', 'BSDELTA']]
-            curve['color'] = curve.BSDELTA.apply(lambda x: 'r' if x < bs_delta_threshold else 'g')
-            itm_delta10_curve = curve[curve.BSDELTA > bs_delta_threshold]
-            A, P, B, S, M = calibrate(itm_delta10_curve)
+        calibrated = calibrate_maturity(timestamp, i, options_df[options_df.tau == mat_vec[i]], bs_delta_threshold)
+        if calibrated is not None:
+            svi_param[i], svi_stats[i] = calibrated
+
+    save_calibration(timestamp, currency, svi_param, svi_stats, publish)
+
+
+def calibrate_maturity(timestamp, i, options_slice, bs_delta_threshold=0.1):
+    # calibrate and plot a single maturity (MONEYNESS and BSDELTA already set), returns None when it fails
+    t = options_slice.tau.iloc[0]
+    try:
+        curve = options_slice.sort_values('STRIKE')
+        curve = curve[['MONEYNESS', 'IMPLIEDVOL', 'tau', 'BSDELTA']]
+        curve['color'] = curve.BSDELTA.apply(lambda x: 'r' if x < bs_delta_threshold else 'g')
+        A, P, B, S, M, stats = cached_calibrate(curve, bs_delta_threshold)
+        curve['CALCULATEDVOL'] = curve.apply(calculate_svi_vol, A=A, P=P, B=B, S=S, M=M, axis=1)
+        svi_dict = {"t": t, "A": A, "P": P, "B": B, "S": S, "M": M}
+        curve.plot(x='MONEYNESS', y=['IMPLIEDVOL', 'CALCULATEDVOL'], title=f"t = {t}", style='.-')
+        save_plot(f'{timestamp}/example_calibration_{i}.png')
+        return svi_dict, {**svi_dict, **stats}
+    except:
+        curve = options_slice.sort_values('STRIKE')
+        curve = curve[['MONEYNESS', 'IMPLIEDVOL', 'tau']]
+        print(f'cannot calibrate for t={t}, plot implied vol instead')
+        curve.plot(x='MONEYNESS', y='IMPLIEDVOL', title=f"(fail to calibrate), t = {t}")
+        save_plot(f'{timestamp}/example_calibration_{i}.png')
+        return None
+    finally:
+        print(f'done for t={t}')
+
+
+def save_plot(path):
+    # pyplot is not thread safe, render here and leave only the file write to the background writer
+    buf = io.BytesIO()
+    plt.savefig(buf, format='png')
+    plt.close()
+    write_behind(path, buf.getvalue())
+
+
+def save_calibration(timestamp, currency, svi_param, svi_stats, publish=False, engine='raw'):
+    write_behind(f'{timestamp}/{param_fnames[engine]}', json.dumps(svi_param))
+    print(f'Queued SVI params for saving.')
+
+    if cache_stats['hits'] + cache_stats['misses'] > 0:
+        print(f"Calibration cache: {cache_stats['hits']} hits, {cache_stats['misses']} misses, {cache_stats['evictions']} evictions")
+    # the store append (file lock + rewrite) and the surface table (fsync) run on the background writer
+    if is_snapshot(timestamp):
+        run_behind(append_job, timestamp, currency, svi_stats, engine)
+    else:
+        print(f'{timestamp} is not named yyyymmdd_hhmmss, not added to the parameter store.')
+
+    # only live captures replace the shared surface table, its readers pick it up on their next refresh
+    if publish and any(p["t"] > 0 for p in svi_param.values()):
+        run_behind(publish_surface, svi_param, timestamp)
+
+
+def append_job(timestamp, currency, svi_stats, engine):
+    version = append_calibration(timestamp, currency, svi_stats, engine=engine)
+    print(f'Appended {engine} SVI params to parameter store as version {version}.')
+
+
+def ssvi_calibration(timestamp, options_df, bs_delta_threshold=0.1, currency='BTC', publish=False):
+    # all maturities fitted jointly by one SSVI surface, saved as the equivalent raw SVI slices
+    options_df['MONEYNESS'] = np.log(options_df.STRIKE / options_df.FUTUREPRICE)
+    options_df['BSDELTA'] = options_df.apply(lambda x: bsdelta(x.MONEYNESS, x.IMPLIEDVOL, x.tau, x.type), axis=1)
+
+    fit_df = options_df[(options_df.BSDELTA > bs_delta_threshold) & (options_df.tau > 0)]
+    surface, res = calibrate_ssvi(fit_df)
+    print(f"SSVI surface: rho = {surface['rho']}, eta = {surface['eta']}, gamma = {surface['gamma']}, {res.nfev} evaluations")
+
+    svi_param = {}
+    svi_stats = {}
+    mat_vec = options_df.tau.unique()
+
+    for i in range(len(mat_vec)):
+        curve = options_df[options_df.tau == mat_vec[i]].sort_values('STRIKE')
+        curve = curve[['MONEYNESS', 'IMPLIEDVOL', 'tau']]
+        j = np.searchsorted(surface["tau"], mat_vec[i])
+        if j == len(surface["tau"]) or surface["tau"][j] != mat_vec[i]:
+            print(f'cannot calibrate for t={mat_vec[i]}, plot implied vol instead')
+            curve.plot(x='MONEYNESS', y='IMPLIEDVOL', title=f"(fail to calibrate), t = {mat_vec[i]}")
+        else:
+            A, P, B, S, M = ssvi_to_raw(surface["theta"][j], surface["rho"], surface["eta"], surface["gamma"], mat_vec[i])
+            A, P, B, S, M = float(A), float(P), float(B), float(S), float(M)
             curve['CALCULATEDVOL'] = curve.apply(calculate_svi_vol, A=A, P=P, B=B, S=S, M=M, axis=1)
             svi_dict = {"t": mat_vec[i], "A": A, "P": P, "B": B, "S": S, "M": M}
             svi_param[i] = svi_dict
-            curve.plot(x='MONEYNESS', y=['IMPLIEDVOL', 'CALCULATEDVOL'], title=f"t = {mat_vec[i]}", style='.-')
-            plt.savefig(f'{timestamp}/example_calibration_{i}.png')
-            plt.close()
-        except:
-            curve = options_df[options_df.tau == mat_vec[i]].sort_values('STRIKE')
-            curve = curve[['MONEYNESS', 'IMPLIEDVOL', 'tau']]
-            print(f'cannot calibrate for t={mat_vec[i]}, plot implied vol instead')
-            curve.plot(x='MONEYNESS', y='IMPLIEDVOL', title=f"(fail to calibrate), t = {mat_vec[i]}")
-            plt.savefig(f'{timestamp}/example_calibration_{i}.png')
-            plt.close()
-        finally:
-            print(f'done for t={mat_vec[i]}')
+            # least_squares reports no iteration count, nit is left at the store default (-1)
+            svi_stats[i] = {**svi_dict, "rmse": float(surface["rmse"][j]), "nfev": int(res.nfev),
+                            "success": bool(res.success), "strategy": "ssvi"}
+            curve.plot(x='MONEYNESS', y=['IMPLIEDVOL', 'CALCULATEDVOL'], title=f"(SSVI) t = {mat_vec[i]}", style='.-')
+        save_plot(f'{timestamp}/example_calibration_{i}.png')
 
-    with open(f'{timestamp}/svi_param_initial.json', "w") as outfile:
-        json.dump(svi_param, outfile)
-        print(f'Saved SVI params.')
+    save_calibration(timestamp, currency, svi_param, svi_stats, publish, engine='ssvi')
 
 
 def second_calibration(timestamp, options_df, bs_delta_threshold=0.1):
@@ -55,27 +131,46 @@ def second_calibration(timestamp, options_df, bs_delta_threshold=0.1):
         svi_param_dict[t] = svi_param_dict_extract[svi_param]
 
     h_params = retrieve_calibration_hyperparameters()
+    (h_params, recalibrated_svi_param, rounds) = penalty_refit(options_df, bs_delta_threshold, h_params, svi_param_dict)
+    print(f'Remaining butterfly arbitrage {h_params["butarb"]}, calendar arbitrage {h_params["calarb"]} after {rounds} joint solve(s)')
+    svi_param = {i: {"t": t, **recalibrated_svi_param[t]} for i, t in enumerate(sorted(recalibrated_svi_param))}
+    write_behind(f'{timestamp}/svi_param_recal.json', json.dumps(svi_param))
+    print(f'Queued re-calibrated SVI params for saving.')
+    return recalibrated_svi_param
 
+def penalty_refit(options_df, bs_delta_threshold, h_params, svi_param_dict):
+    # normally met by the first joint solve, penalties are doubled and the solve warm started otherwise
     butarb = h_params["butarb"]
     blim = h_params["blim"]
     calarb = h_params["calarb"]
     clim = h_params["clim"]
 
-    while butarb > blim or calarb > clim:
-        (h_params, recalibrated_svi_param) = calibration_with_penalty(options_df, bs_delta_threshold, h_params, svi_param_dict)
+    rounds = 0
+    while (butarb > blim or calarb > clim) and rounds < h_params.get("maxrounds", 8):
+        (h_params, svi_param_dict) = calibration_with_penalty(options_df, bs_delta_threshold, h_params, svi_param_dict)
         butarb = h_params["butarb"]
         blim = h_params["blim"]
         calarb = h_params["calarb"]
         clim = h_params["clim"]
-
-    return recalibrated_svi_param
+        rounds += 1
+    return (h_params, svi_param_dict, rounds)
 
 def calibration_with_penalty(options_df, bs_delta_threshold, h_params, previous_svi_param):
-    t_prev = 0
-    for t, svi_params in previous_svi_param:
-        temp = sp.optimize.leastsq(residuals, x0=svi_params, args=(t, previous_svi_param, options_df, bs_delta_threshold, grid, h_params))
+    # all slices refitted together in one sparse least-squares solve, see jointRefit.py
+    taus = np.array(sorted(previous_svi_param))
+    x0 = np.array([[previous_svi_param[t][name] for name in ["A", "P", "B", "S", "M"]] for t in taus])
+    fit_df = options_df[(options_df.BSDELTA > bs_delta_threshold)
+                        & np.isclose(options_df.tau.to_numpy()[:, None], taus[None, :]).any(axis=1)]
 
-        t_prev = t
-    #return (h_params, recalibrated_svi_param)
-    pass
+    log_msg = f'Butterfly penalty factor: {h_params["bpen"]}, calendar penalty factor: {h_params["cpen"]}'
+    print(log_msg)
+    params, butarb, calarb, res = joint_refit(fit_df, taus, x0, h_params["bpen"], h_params["cpen"])
+    print(f'Joint solve of {len(taus)} slices: {res.nfev} evaluations, butterfly {butarb}, calendar {calarb}')
 
+    h_params = {**h_params, "butarb": butarb, "calarb": calarb}
+    if butarb > h_params["blim"]:
+        h_params["bpen"] *= 2
+    if calarb > h_params["clim"]:
+        h_params["cpen"] *= 2
+    recalibrated_svi_param = {float(t): dict(zip(["A", "P", "B", "S", "M"], map(float, p))) for t, p in zip(taus, params)}
+    return (h_params, recalibrated_svi_param)
@@ -1,13 +1,16 @@
 import json
 
-import pandas as pd
-
-from modules.DeribitAPI.deribit_interface import get_deribit_data
+from modules.DeribitAPI.deribit_interface import get_deribit_data, uri as deribit_uri
 from modules.dataCleaning import clean_up_option_data, compliment_futures_in_options, select_put_call
+from modules.paramStore import is_snapshot, query_snapshot, rows_to_svi_param_dict
+from modules.persistence import read_snapshot, flush
+
+# initial parameters of each calibration engine in the snapshot folder
+param_fnames = {'raw': 'svi_param_initial.json', 'ssvi': 'svi_param_ssvi.json'}
 
 
-def retrieve_data_live():
-    data = get_deribit_data()
+def retrieve_data_live(uri=deribit_uri):
+    data = get_deribit_data(uri=uri)
     datetime = data["dateTime"]
     futures = data["futures"]
     options_df = data["options"]
@@ -18,16 +21,22 @@ def retrieve_data_live():
 
 
 def retrieve_data_source(input_timestamp):
-    futures = pd.read_csv(f'{input_timestamp}/Futures.csv')
-    options_df = pd.read_csv(f'{input_timestamp}/Options.csv')
+    flush()  # the snapshot may still be queued by a capture in this process
+    futures, options_df = read_snapshot(input_timestamp)
     options_df = clean_up_option_data(options_df)
     (options_df, futures_df) = compliment_futures_in_options(options_df, futures)
     options_df = select_put_call(options_df)
     return options_df, futures_df
 
 
-def retrieve_initial_svi_param_dict(timestamp):
-    with open(f'{timestamp}/svi_param_initial.json', 'r') as f:
+def retrieve_initial_svi_param_dict(timestamp, currency='BTC', engine='raw'):
+    # prefer the parameter store, folders calibrated before it existed only have the json
+    flush()  # a calibration in this process may still be appending to the store
+    if is_snapshot(timestamp):
+        rows = query_snapshot(timestamp, currency=currency, engine=engine)
+        if len(rows['tau']) > 0:
+            return rows_to_svi_param_dict(rows)
+    with open(f'{timestamp}/{param_fnames[engine]}', 'r') as f:
         svi_param_initial = json.load(f)
     return svi_param_initial
 
@@ -1,3 +1,4 @@
+import os
 from scipy import optimize
 from py_vollib.black import implied_volatility
 import numpy as np
@@ -24,7 +25,7 @@ def acceptable(S, a, d, c, vT):
 
 
 # The error function from the optimizer, in terms of a, d and c so we don't need to keep dividing by T:
-def sum_of_squares(x, a, d, c, vT):
+def sum_of_squares_numpy(x, a, d, c, vT):
     diff = a + d * x + c * np.sqrt(x * x + 1) - vT
     return (diff * diff).sum()
 
@@ -33,17 +34,25 @@ def sum_of_squares(x, a, d, c, vT):
 # the lowest sum-of-squares error when the gradient of the `f` function is zero,
 # ensuring that the parameters remain in the domain `D` identified in the paper.
 
-def solve_grad(S, M, x, vT):
-    ys = (x - M) / S
+def solve_grad_numpy(S, M, x, vT, work=None):
+    # work (2, len(x)) is scratch space for y and sqrt(y^2 + 1), reused across objective calls by calibrate()
+    if work is None:
+        work = np.empty((2, len(x)))
+    ys, r = work
+    np.subtract(x, M, out=ys)
+    ys /= S
+    np.multiply(ys, ys, out=r)
+    r += 1
+    np.sqrt(r, out=r)
 
     y = ys.sum()
-    y2 = (ys * ys).sum()
-    y2one = (ys * ys + 1).sum()
-    ysqrt = np.sqrt(ys * ys + 1).sum()
-    y2sqrt = (ys * np.sqrt(ys * ys + 1)).sum()
+    y2 = ys @ ys
+    y2one = y2 + len(ys)
+    ysqrt = r.sum()
+    y2sqrt = ys @ r
     v = vT.sum()
-    vy = (vT * ys).sum()
-    vsqrt = (vT * np.sqrt(ys * ys + 1)).sum()
+    vy = vT @ ys
+    vsqrt = vT @ r
 
     matrix = [
         [1, y, ysqrt],
@@ -54,7 +63,7 @@ def solve_grad(S, M, x, vT):
     _a, _d, _c = np.linalg.solve(np.array(matrix), np.array(vector))
 
     if acceptable(S, _a, _d, _c, vT):
-        return _a, _d, _c, sum_of_squares(ys, _a, _d, _c, vT)
+        return _a, _d, _c, sum_of_squares_numpy(ys, _a, _d, _c, vT)
 
     _a, _d, _c, _cost = None, None, None, None
     for matrix, vector, clamp_params in [
@@ -80,7 +89,7 @@ def solve_grad(S, M, x, vT):
             a = min(max(a, 0), vT.max())
             d = min(max(d, -dmax), dmax)
             c = min(max(c, 0), 4 * S)
-        cost = sum_of_squares(ys, a, d, c, vT)
+        cost = sum_of_squares_numpy(ys, a, d, c, vT)
         if acceptable(S, a, d, c, vT) and (_cost is None or cost < _cost):
             _a, _d, _c, _cost = a, d, c, cost
 
@@ -89,24 +98,32 @@ def solve_grad(S, M, x, vT):
 
 # Use scipy's optimizer to minimize the error function
 def solve_grad_get_score(S_M, x_vT):
+    # x_vT is [x, vT] or [x, vT, work], work being the scratch buffer of solve_grad
     S, M = S_M
-    x, vT = x_vT
-    return solve_grad(S, M, x, vT)[3]
+    return solve_grad(S, M, *x_vT)[3]
 
-def calibrate(df):
-    vT = df.IMPLIEDVOL * df.IMPLIEDVOL * df.tau
-    res = optimize.minimize(solve_grad_get_score, [.1, .0], args=[df.MONEYNESS, vT], bounds=[(0.001, None), (None, None)])
+def calibrate(df, return_stats=False):
+    x = df.MONEYNESS.to_numpy(dtype=np.float64)
+    vT = (df.IMPLIEDVOL * df.IMPLIEDVOL * df.tau).to_numpy(dtype=np.float64)
+    work = np.empty((2, len(x)))  # one scratch buffer for every objective evaluation of the fit
+    res = optimize.minimize(solve_grad_get_score, [.1, .0], args=[x, vT, work], bounds=[(0.001, None), (None, None)])
     assert res.success
     S, M = res.x
-    a, d, c, _ = solve_grad(S, M, df.MONEYNESS, vT)
+    a, d, c, _ = solve_grad(S, M, x, vT, work)
     T = df.tau.max() # should be the same for all rows
     A, P, B = a / T, d / c, c / (S * T)
     # assert T >= 0 and S >= 0 and abs(P) <= 1
+    if return_stats:
+        resid = svi(A, P, B, S, M, x, out=work[0])  # the scratch of the fit is free again, reuse it
+        resid -= df.IMPLIEDVOL.to_numpy(dtype=np.float64)
+        rmse = np.sqrt(resid @ resid / len(resid))
+        stats = {"rmse": float(rmse), "nfev": int(res.nfev), "nit": int(res.nit), "success": bool(res.success)}
+        return A, P, B, S, M, stats
     return A, P, B, S, M
 
 # SVI formula for the volatility (not variance):
-def svi(A, P, B, S, M, x):
-    return np.sqrt(A + B * (P * (x - M) + np.sqrt((x - M) * (x - M) + S * S)))
+def svi_numpy(A, P, B, S, M, x, out=None):
+    return np.sqrt(A + B * (P * (x - M) + np.sqrt((x - M) * (x - M) + S * S)), out=out)
 
 def calculate_svi_vol(row, A, P, B, S, M):
     return svi(A, P, B, S, M, row.MONEYNESS)
@@ -124,7 +141,7 @@ def volsurface(slices, t, moneyness):
     return (1 - fraction) * slices.iat[ts[0]](moneyness) + fraction * slices.iat[ts[1]](moneyness)
 
 
-def bsdelta(moneyness, vol, maturity, opt_type):
+def bsdelta_numpy(moneyness, vol, maturity, opt_type):
     if maturity < 1e-10: maturity = 0.002 # less than a day
     d1 = 1 / vol / np.sqrt(maturity) * (-moneyness + 0.5 * vol * vol * maturity)
     if opt_type.lower() == 'call':
@@ -135,6 +152,71 @@ def bsdelta(moneyness, vol, maturity, opt_type):
         raise ValueError(f"Unknown option type: {opt_type}")
 
 
+# Hyperbola asymptotes parametrisation of the total variance, and its first and second derivatives in x
+def straightSVI_numpy(x, m1, m2, q1, q2, c):
+    return ((m1+m2)*x+q1+q2+np.sqrt(((m1+m2)*x+q1+q2)**2-4*(m1*m2*x**2+(m1*q2+m2*q1)*x+q1*q2-c)))/2
+def straightSVIp_numpy(x, m1, m2, q1, q2, c):
+    H=np.sqrt(((m1+m2)*x+q1+q2)**2-4*(m1*m2*x**2+(m1*q2+m2*q1)*x+q1*q2-c))
+    return ((m1+m2)+((m1+m2)*((m1+m2)*x+q1+q2)-4*m1*m2*x-2*(m1*q2+m2*q1))/H)/2
+def straightSVIpp_numpy(x, m1, m2, q1, q2, c):
+    H=np.sqrt(((m1+m2)*x+q1+q2)**2-4*(m1*m2*x**2+(m1*q2+m2*q1)*x+q1*q2-c))
+    A=(2*(m1+m2)**2-8*m1*m2)/H
+    B=(2*(m1+m2)*((m1+m2)*x+q1+q2)-8*m1*m2*x-4*(m1*q2+m2*q1))**2/H**3/2
+    return (A-B)/4
+
+
+# Kernel backends: 'numpy' (reference, always available) or 'numba' (JIT compiled, see formulas_numba.py).
+# Select with set_backend() or the SVI_BACKEND environment variable, the functions below dispatch to it.
+kernel_names = ['svi', 'sum_of_squares', 'solve_grad', 'bsdelta', 'straightSVI', 'straightSVIp', 'straightSVIpp']
+backends = {'numpy': {name: globals()[f'{name}_numpy'] for name in kernel_names}}
+active_backend = {'name': 'numpy', 'kernels': backends['numpy']}
+
+
+def load_backend(name):
+    if name not in backends:
+        if name != 'numba':
+            raise ValueError(f"Unknown kernel backend: {name}")
+        from modules.formulas_numba import numba_kernels  # raises ImportError when numba is not installed
+        backends[name] = numba_kernels()
+    return backends[name]
+
+
+def set_backend(name):
+    active_backend['kernels'] = load_backend(name)
+    active_backend['name'] = name
+
+
+def get_backend():
+    return active_backend['name']
+
+
+def svi(A, P, B, S, M, x, out=None):
+    # out: optional float64 array shaped like x to write the volatilities into instead of a new array
+    return active_backend['kernels']['svi'](A, P, B, S, M, x, out)
+
+def sum_of_squares(x, a, d, c, vT):
+    return active_backend['kernels']['sum_of_squares'](x, a, d, c, vT)
+
+def solve_grad(S, M, x, vT, work=None):
+    return active_backend['kernels']['solve_grad'](S, M, x, vT, work)
+
+def bsdelta(moneyness, vol, maturity, opt_type):
+    return active_backend['kernels']['bsdelta'](moneyness, vol, maturity, opt_type)
+
+def straightSVI(x, m1, m2, q1, q2, c):
+    return active_backend['kernels']['straightSVI'](x, m1, m2, q1, q2, c)
+
+def straightSVIp(x, m1, m2, q1, q2, c):
+    return active_backend['kernels']['straightSVIp'](x, m1, m2, q1, q2, c)
+
+def straightSVIpp(x, m1, m2, q1, q2, c):
+    return active_backend['kernels']['straightSVIpp'](x, m1, m2, q1, q2, c)
+
+
+if os.environ.get('SVI_BACKEND'):
+    set_backend(os.environ['SVI_BACKEND'])
+
+
 def moneyness_func(options, futures, strike, t_mat):
     S0 = options.Spot.iloc[0]
     imp_r = np.interp(t_mat, futures.t, futures.imp_r)
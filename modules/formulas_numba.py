@@ -0,0 +1,175 @@
+import math
+import sys
+import numpy as np
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+# Numba compiled versions of the hot kernels in formulas.py, same signatures and results.
+# Only imported through formulas.set_backend('numba'), numba stays an optional dependency.
+
+eps = sys.float_info.epsilon
+
+# boundary systems of formulas.solve_grad, in the same order, built once and frozen into the compiled kernel.
+# SYSTEMS picks the three rows of each system: 0-2 are the rows of the normal equations, 3-7 the constant rows of
+# BOUNDARY_ROWS. VECTOR_TERMS picks the right hand side out of (0, v, vy, vsqrt, vTmax, 4S).
+BOUNDARY_ROWS = np.array([[1.0, 0.0, 0.0], [0.0, -1.0, 1.0], [0.0, 1.0, 1.0], [0.0, 0.0, 1.0], [0.0, 1.0, 0.0]])
+SYSTEMS = np.array([
+    [3, 1, 2], [3, 1, 2], [0, 4, 2], [0, 5, 2], [0, 5, 2], [0, 4, 2], [0, 1, 6], [0, 1, 6],
+    [0, 7, 6], [0, 7, 6], [3, 4, 2], [3, 5, 2], [3, 5, 2], [3, 4, 2],
+])
+VECTOR_TERMS = np.array([
+    [0, 2, 3], [4, 2, 3], [1, 0, 3], [1, 0, 3], [1, 5, 3], [1, 5, 3], [1, 2, 0], [1, 2, 5],
+    [1, 0, 0], [1, 0, 5], [0, 0, 3], [0, 0, 3], [0, 5, 3], [0, 5, 3],
+])
+
+
+def numba_kernels():
+    if numba is None:
+        raise ImportError("the 'numba' kernel backend needs numba installed")
+    njit = numba.njit(cache=True, fastmath=False)
+
+    @njit
+    def svi_kernel(A, P, B, S, M, x, out):
+        for i in range(x.shape[0]):
+            y = x[i] - M
+            out[i] = math.sqrt(A + B * (P * y + math.sqrt(y * y + S * S)))
+        return out
+
+    @njit
+    def sum_of_squares_kernel(x, a, d, c, vT):
+        total = 0.0
+        for i in range(x.shape[0]):
+            diff = a + d * x[i] + c * math.sqrt(x[i] * x[i] + 1) - vT[i]
+            total += diff * diff
+        return total
+
+    @njit
+    def acceptable_kernel(S, a, d, c, vTmax):
+        return -eps <= c and c <= 4 * S + eps and abs(d) <= min(c, 4 * S - c) + eps \
+            and -eps <= a and a <= vTmax + eps and c > 0
+
+    @njit
+    def solve_grad_kernel(S, M, x, vT, ys):
+        # single pass over the data for the normal equation sums, ys is caller provided scratch for the scaled x
+        n = x.shape[0]
+        y = y2 = ysqrt = y2sqrt = v = vy = vsqrt = 0.0
+        vTmax = -np.inf
+        for i in range(n):
+            yi = (x[i] - M) / S
+            r = math.sqrt(yi * yi + 1)
+            ys[i] = yi
+            y += yi
+            y2 += yi * yi
+            ysqrt += r
+            y2sqrt += yi * r
+            v += vT[i]
+            vy += vT[i] * yi
+            vsqrt += vT[i] * r
+            vTmax = max(vTmax, vT[i])
+        y2one = y2 + n
+
+        matrix = np.array([[1.0, y, ysqrt], [y, y2, y2sqrt], [ysqrt, y2sqrt, y2one]])
+        vector = np.array([v, vy, vsqrt])
+        sol = np.linalg.solve(matrix, vector)
+        if acceptable_kernel(S, sol[0], sol[1], sol[2], vTmax):
+            return sol[0], sol[1], sol[2], sum_of_squares_kernel(ys, sol[0], sol[1], sol[2], vT)
+
+        terms = np.array([0.0, v, vy, vsqrt, vTmax, 4 * S])
+        best_a, best_d, best_c, best_cost = np.nan, np.nan, np.nan, np.inf
+        found = False
+        m = np.empty((3, 3))
+        rhs = np.empty(3)
+        for k in range(SYSTEMS.shape[0]):
+            for j in range(3):
+                row = SYSTEMS[k, j]
+                m[j, :] = matrix[row] if row < 3 else BOUNDARY_ROWS[row - 3]
+                rhs[j] = terms[VECTOR_TERMS[k, j]]
+            sol = np.linalg.solve(m, rhs)
+            a, d, c = sol[0], sol[1], sol[2]
+            if k >= 8:  # clamp_params
+                dmax = min(c, 4 * S - c)
+                a = min(max(a, 0.0), vTmax)
+                d = min(max(d, -dmax), dmax)
+                c = min(max(c, 0.0), 4 * S)
+            cost = sum_of_squares_kernel(ys, a, d, c, vT)
+            if acceptable_kernel(S, a, d, c, vTmax) and (not found or cost < best_cost):
+                best_a, best_d, best_c, best_cost = a, d, c, cost
+                found = True
+        if not found:
+            best_cost = np.nan
+        return best_a, best_d, best_c, best_cost
+
+    @njit
+    def bsdelta_kernel(moneyness, vol, maturity, is_call):
+        if maturity < 1e-10:
+            maturity = 0.002  # less than a day
+        d1 = 1 / vol / math.sqrt(maturity) * (-moneyness + 0.5 * vol * vol * maturity)
+        cdf = 0.5 * math.erfc(-d1 / math.sqrt(2.0))
+        return cdf if is_call else 1 - cdf
+
+    @njit
+    def straight_kernel(x, m1, m2, q1, q2, c, order, out):
+        for i in range(x.shape[0]):
+            xi = x[i]
+            L = (m1 + m2) * xi + q1 + q2
+            H = math.sqrt(L * L - 4 * (m1 * m2 * xi * xi + (m1 * q2 + m2 * q1) * xi + q1 * q2 - c))
+            if order == 0:
+                out[i] = (L + H) / 2
+            elif order == 1:
+                out[i] = ((m1 + m2) + ((m1 + m2) * L - 4 * m1 * m2 * xi - 2 * (m1 * q2 + m2 * q1)) / H) / 2
+            else:
+                Ap = (2 * (m1 + m2) ** 2 - 8 * m1 * m2) / H
+                Bp = (2 * (m1 + m2) * L - 8 * m1 * m2 * xi - 4 * (m1 * q2 + m2 * q1)) ** 2 / H ** 3 / 2
+                out[i] = (Ap - Bp) / 4
+        return out
+
+    def as_array(x, out=None):
+        # kernels run on 1-d float64 arrays, scalars in give scalars out like the numpy backend.
+        # A caller owned out buffer is written in place, otherwise the result is a new array.
+        arr = np.asarray(x, dtype=np.float64)
+        flat = arr.reshape(-1)
+        buf = np.empty_like(flat) if out is None else out.reshape(-1)
+        return flat, buf, arr.ndim == 0, arr.shape
+
+    def svi(A, P, B, S, M, x, out=None):
+        flat, buf, scalar, shape = as_array(x, out)
+        svi_kernel(float(A), float(P), float(B), float(S), float(M), flat, buf)
+        return buf[0] if scalar else buf.reshape(shape)
+
+    def sum_of_squares(x, a, d, c, vT):
+        return sum_of_squares_kernel(np.asarray(x, dtype=np.float64), float(a), float(d), float(c),
+                                     np.asarray(vT, dtype=np.float64))
+
+    def solve_grad(S, M, x, vT, work=None):
+        x = np.asarray(x, dtype=np.float64)
+        if work is None:
+            work = np.empty((2, x.shape[0]))
+        a, d, c, cost = solve_grad_kernel(float(S), float(M), x, np.asarray(vT, dtype=np.float64), work[0])
+        assert not np.isnan(cost), "S=%s, M=%s" % (S, M)
+        return a, d, c, cost
+
+    def bsdelta(moneyness, vol, maturity, opt_type):
+        if opt_type.lower() not in ['call', 'put']:
+            raise ValueError(f"Unknown option type: {opt_type}")
+        return bsdelta_kernel(float(moneyness), float(vol), float(maturity), opt_type.lower() == 'call')
+
+    def straight(order):
+        def kernel(x, m1, m2, q1, q2, c):
+            flat, buf, scalar, shape = as_array(x)
+            straight_kernel(flat, float(m1), float(m2), float(q1), float(q2), float(c), order, buf)
+            return buf[0] if scalar else buf.reshape(shape)
+        return kernel
+
+    return {
+        'svi': svi,
+        'sum_of_squares': sum_of_squares,
+        'solve_grad': solve_grad,
+        'bsdelta': bsdelta,
+        'straightSVI': straight(0),
+        'straightSVIp': straight(1),
+        'straightSVIpp': straight(2),
+    }
+
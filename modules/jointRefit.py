@@ -0,0 +1,147 @@
+import numpy as np
+from scipy import optimize
+from scipy.sparse import lil_matrix
+
+# Penalized refit of all raw SVI slices at once. The parameters (A, P, B, S, M) of every slice are stacked into a
+# single least-squares problem: implied vol errors of each slice, butterfly violations of each slice and calendar
+# violations of each pair of adjacent maturities. A slice only enters its own rows and the calendar rows shared
+# with its neighbours, so the Jacobian is block banded and is solved with a sparse trust region method.
+# Beyond the quoted range the wings are checked analytically, as in recalibrate.py: Lee's moment formula bounds the
+# asymptotic slopes of every slice by 2, and a later slice needs wings at least as steep as the earlier one.
+
+ncheck = 41  # arbitrage check points per slice, over the log-moneyness range of the chain
+nwing = 2  # analytic wing rows per slice and per adjacent pair, left and right
+ncoarse = 17  # uniform points the check grid starts from, refined as adaptive() in recalibrate.py
+nrefine = 5  # bisection passes refining the check grid near violation boundaries
+gtol = 0.05  # butterfly: refine where |g(k)| < gtol or g changes sign
+ctol = 0.05  # calendar: refine where |w2 - w1| < ctol * w1 or w2 - w1 changes sign
+
+
+def raw_svi_total_variance(params, k, tau):
+    """
+    Returns total variance w and its first two derivatives in k for rows of (A, P, B, S, M) parameters
+    """
+    A, P, B, S, M = params.T
+    y = k - M
+    R = np.sqrt(y * y + S * S)
+    w = tau * (A + B * (P * y + R))
+    wp = tau * B * (P + y / R)
+    wpp = tau * B * S * S / R ** 3
+    return w, wp, wpp
+
+
+def durrleman_g(k, w, wp, wpp):
+    # risk neutral density is non-negative iff g >= 0 (Gatheral & Jacquier)
+    return (1 - k * wp / (2 * w)) ** 2 - wp * wp / 4 * (1 / w + 1 / 4) + wpp / 2
+
+
+def wing_slopes(params, taus):
+    # |dw/dk| for k -> -inf and k -> +inf of every slice, (n, 2)
+    A, P, B, S, M = params.T
+    return np.stack([taus * B * (1 - P), taus * B * (1 + P)], axis=1)
+
+
+def slice_terms(params, taus, k):
+    # total variance and Durrleman g of every slice on the points k, both (n, len(k))
+    w, wp, wpp = raw_svi_total_variance(params[:, None, :].repeat(len(k), axis=1).reshape(-1, 5),
+                                        np.tile(k, len(taus)), np.repeat(taus, len(k)))
+    w, wp, wpp = (a.reshape(len(taus), len(k)) for a in (w, wp, wpp))
+    return w, durrleman_g(k[None, :], np.maximum(w, 1e-12), wp, wpp)
+
+
+def check_grid(x, taus, k_min, k_max):
+    """
+    Returns the ncheck arbitrage check points for the slices x: a coarse uniform grid bisected where the butterfly or
+    calendar condition of any slice is close to binding or changes sign, then topped up in the widest gaps so the
+    residual vector of the solve keeps a fixed length
+    """
+    params = x.reshape(-1, 5)
+    k = np.linspace(k_min, k_max, ncoarse)
+    for _ in range(nrefine):
+        w, g = slice_terms(params, taus, k)
+        d = w[1:] - w[:-1]
+        near = (np.abs(g) < gtol).any(axis=0) | (np.abs(d) < ctol * np.abs(w[:-1])).any(axis=0)
+        cross = (np.sign(g[:, :-1]) != np.sign(g[:, 1:])).any(axis=0) | (np.sign(d[:, :-1]) != np.sign(d[:, 1:])).any(axis=0)
+        split = near[:-1] | near[1:] | cross
+        km = ((k[:-1] + k[1:]) / 2)[split][:ncheck - len(k)]
+        if len(km) == 0:
+            break
+        k = np.sort(np.concatenate([k, km]))
+    while len(k) < ncheck:
+        i = np.argmax(np.diff(k))
+        k = np.insert(k, i + 1, (k[i] + k[i + 1]) / 2)
+    return k
+
+
+def arbitrage_terms(x, taus, k_check):
+    """
+    Returns the butterfly violations of every slice (n, ncheck + nwing)
+    and the calendar violations of every adjacent pair (n - 1, ncheck + nwing)
+
+    The first ncheck columns are the violations per check point, the last nwing the left and right wing violations.
+    """
+    params = x.reshape(-1, 5)
+    w, g = slice_terms(params, taus, k_check)
+    butterfly = np.maximum(0, -g)
+    calendar = np.maximum(0, w[:-1] - w[1:])
+    slopes = wing_slopes(params, taus)
+    butterfly = np.concatenate([butterfly, np.maximum(0, slopes - 2)], axis=1)
+    calendar = np.concatenate([calendar, np.maximum(0, slopes[:-1] - slopes[1:])], axis=1)
+    return butterfly, calendar
+
+
+def refit_residuals(x, k, iv, tau, slice_idx, taus, k_check, bpen, cpen):
+    params = x.reshape(-1, 5)
+    w, _, _ = raw_svi_total_variance(params[slice_idx], k, tau)
+    fit = np.sqrt(np.maximum(w, 1e-12) / tau) - iv
+    butterfly, calendar = arbitrage_terms(x, taus, k_check)
+    return np.concatenate([fit, np.sqrt(bpen) * butterfly.ravel(), np.sqrt(cpen) * calendar.ravel()])
+
+
+def refit_sparsity(slice_idx, n):
+    nrow = ncheck + nwing
+    m = len(slice_idx) + n * nrow + (n - 1) * nrow
+    sparsity = lil_matrix((m, 5 * n), dtype=int)
+    for row, i in enumerate(slice_idx):
+        sparsity[row, 5 * i:5 * i + 5] = 1
+    row = len(slice_idx)
+    for i in range(n):
+        sparsity[row:row + nrow, 5 * i:5 * i + 5] = 1
+        row += nrow
+    for i in range(1, n):
+        sparsity[row:row + nrow, 5 * (i - 1):5 * i + 5] = 1
+        row += nrow
+    return sparsity.tocsr()
+
+
+def joint_refit(df, taus, x0, bpen, cpen):
+    """
+    Refits every slice at once with butterfly and calendar penalties, returns (params (n, 5), butarb, calarb, result)
+
+    butarb and calarb follow recalibrate.py: the largest per-slice sum of violations over the check grid and the wings.
+
+    Arguments:
+        df (DataFrame): Quotes to fit with MONEYNESS, IMPLIEDVOL and tau, tau matching one of taus
+        taus (array): Maturities of the slices, increasing
+        x0 (array): Starting (A, P, B, S, M) of every slice, shape (n, 5)
+        bpen, cpen (float): Butterfly and calendar penalty factors
+    """
+    n = len(taus)
+    k = df.MONEYNESS.to_numpy(dtype=float)
+    iv = df.IMPLIEDVOL.to_numpy(dtype=float)
+    tau = df.tau.to_numpy(dtype=float)
+    slice_idx = np.abs(tau[:, None] - taus[None, :]).argmin(axis=1)
+    # the grid follows the starting slices, penalty_refit re-adapts it on every warm started round
+    k_check = check_grid(np.asarray(x0, dtype=float), taus, k.min(), k.max())
+
+    lower = np.tile([-np.inf, -0.999, 0.0, 1e-4, -np.inf], n)
+    upper = np.tile([np.inf, 0.999, np.inf, np.inf, np.inf], n)
+    x0 = np.clip(np.asarray(x0, dtype=float).ravel(), lower, upper)
+    res = optimize.least_squares(refit_residuals, x0, bounds=(lower, upper), method='trf',
+                                 jac_sparsity=refit_sparsity(slice_idx, n), tr_solver='lsmr', ftol=1e-6,
+                                 args=(k, iv, tau, slice_idx, taus, k_check, bpen, cpen))
+    # reported on a grid adapted to the refitted slices
+    butterfly, calendar = arbitrage_terms(res.x, taus, check_grid(res.x, taus, k.min(), k.max()))
+    butarb = float(butterfly.sum(axis=1).max())
+    calarb = float(calendar.sum(axis=1).max()) if n > 1 else 0.0
+    return res.x.reshape(n, 5), butarb, calarb, res
@@ -0,0 +1,187 @@
+import os
+import fcntl
+import datetime
+import numpy as np
+
+store_fname = 'svi_param_store.npz'
+
+# one typed array per column, rows kept sorted on (snapshot, currency, version, tau)
+STORE_COLUMNS = [
+    ('snapshot', 'datetime64[s]'),  # local time of the capture folder, yyyymmdd_hhmmss
+    ('currency', 'U8'),
+    ('version', 'i8'),  # re-calibrating the same snapshot appends a new version
+    ('slice', 'i8'),  # positional index of the maturity in the snapshot (svi_param_initial.json key)
+    ('tau', 'f8'),
+    ('A', 'f8'),
+    ('P', 'f8'),
+    ('B', 'f8'),
+    ('S', 'f8'),
+    ('M', 'f8'),
+    ('rmse', 'f8'),  # fit RMSE in implied vol over the calibrated points
+    ('nfev', 'i8'),
+    ('nit', 'i8'),
+    ('success', '?'),
+    ('strategy', 'U24'),  # 'primary', or the recovery strategy of a slice calibrate() failed on
+    ('engine', 'U8'),  # 'raw' per-slice fits or 'ssvi' surface, versions of the two are kept apart
+]
+
+
+def snapshot_to_datetime64(timestamp):
+    """
+    Converts a snapshot folder (yyyymmdd_hhmmss, parent folders allowed) or datetime into numpy datetime64[s]
+    """
+    if isinstance(timestamp, str):
+        timestamp = datetime.datetime.strptime(os.path.basename(os.path.normpath(timestamp)), "%Y%m%d_%H%M%S")
+    return np.datetime64(timestamp, 's')
+
+
+def is_snapshot(timestamp):
+    # folders not named after their capture time (yyyymmdd_hhmmss) are kept out of the store
+    try:
+        snapshot_to_datetime64(timestamp)
+    except ValueError:
+        return False
+    return True
+
+
+def empty_store():
+    return {name: np.empty(0, dtype=dtype) for name, dtype in STORE_COLUMNS}
+
+
+def load_store(fname=store_fname):
+    """
+    Returns the store as a dictionary of column name -> numpy array
+
+    Arguments:
+        fname (str): Path of the .npz store, an empty store is returned if it does not exist
+    """
+    if not os.path.exists(fname):
+        return empty_store()
+    with np.load(fname, allow_pickle=False) as f:
+        store = {name: f[name] for name in f.files}
+    # stores written before a column existed get it filled with defaults
+    n = len(store['snapshot'])
+    for name, dtype in STORE_COLUMNS:
+        if name not in store:
+            defaults = {'strategy': 'primary', 'engine': 'raw'}
+            store[name] = np.full(n, defaults[name], dtype=dtype) if name in defaults else np.zeros(n, dtype=dtype)
+    return store
+
+
+def save_store(store, fname=store_fname):
+    # write to a temporary file and swap it in, readers never see a half written store
+    tmp_fname = f'{fname}.{os.getpid()}.tmp'
+    with open(tmp_fname, 'wb') as f:
+        np.savez(f, **store)
+    os.replace(tmp_fname, fname)
+
+
+def append_calibration(timestamp, currency, svi_rows, engine='raw', fname=store_fname):
+    """
+    Appends one calibration run to the store and returns its version number
+
+    The read-modify-write holds an exclusive lock on <fname>.lock, concurrent appends from other processes wait
+    instead of overwriting each other's rows.
+
+    Arguments:
+        timestamp (str): Snapshot folder name, yyyymmdd_hhmmss
+        currency (str): Cryptocurrency, official three-letter abbreviation
+        svi_rows (dict): Slice index -> {"t", "A", "P", "B", "S", "M"} plus optional "rmse", "nfev", "nit", "success", "strategy"
+        engine (str): 'raw' or 'ssvi', each engine has its own versions of a snapshot
+        fname (str): Path of the .npz store
+    """
+    with open(f'{fname}.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            return append_locked(timestamp, currency, svi_rows, engine, fname)
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def append_locked(timestamp, currency, svi_rows, engine, fname):
+    store = load_store(fname)
+    snapshot = snapshot_to_datetime64(timestamp)
+
+    same_run = (store['snapshot'] == snapshot) & (store['currency'] == currency) & (store['engine'] == engine)
+    version = int(store['version'][same_run].max()) + 1 if same_run.any() else 0
+
+    n = len(svi_rows)
+    new_rows = {
+        'snapshot': np.full(n, snapshot, dtype='datetime64[s]'),
+        'currency': np.full(n, currency, dtype='U8'),
+        'version': np.full(n, version, dtype='i8'),
+        'slice': np.array([int(i) for i in svi_rows], dtype='i8'),
+        'tau': np.array([row['t'] for row in svi_rows.values()], dtype='f8'),
+    }
+    for name in ['A', 'P', 'B', 'S', 'M']:
+        new_rows[name] = np.array([row[name] for row in svi_rows.values()], dtype='f8')
+    new_rows['rmse'] = np.array([row.get('rmse', np.nan) for row in svi_rows.values()], dtype='f8')
+    new_rows['nfev'] = np.array([row.get('nfev', -1) for row in svi_rows.values()], dtype='i8')
+    new_rows['nit'] = np.array([row.get('nit', -1) for row in svi_rows.values()], dtype='i8')
+    new_rows['success'] = np.array([row.get('success', True) for row in svi_rows.values()], dtype='?')
+    new_rows['strategy'] = np.array([row.get('strategy', 'primary') for row in svi_rows.values()], dtype='U24')
+    new_rows['engine'] = np.full(n, engine, dtype='U8')
+
+    store = {name: np.concatenate([store[name], new_rows[name].astype(dtype)]) for name, dtype in STORE_COLUMNS}
+    order = np.lexsort((store['tau'], store['version'], store['currency'], store['snapshot']))
+    store = {name: store[name][order] for name in store}
+    save_store(store, fname)
+    return version
+
+
+def latest_version_mask(store):
+    # True for the rows belonging to the newest version of every (snapshot, currency, engine) run
+    if len(store['snapshot']) == 0:
+        return np.zeros(0, dtype='?')
+    keys = np.char.add(np.char.add(store['snapshot'].astype('U19'), store['currency']), store['engine'])
+    _, run_id = np.unique(keys, return_inverse=True)
+    latest = np.full(run_id.max() + 1, -1, dtype='i8')
+    np.maximum.at(latest, run_id, store['version'])
+    return store['version'] == latest[run_id]
+
+
+def query_range(start=None, end=None, currency=None, engine=None, columns=None, all_versions=False, fname=store_fname):
+    """
+    Returns the rows with start <= snapshot <= end as a dictionary of numpy arrays
+
+    Arguments:
+        start, end (str or datetime): Snapshot bounds (yyyymmdd_hhmmss), open ended when None
+        currency (str): Restrict to a single currency
+        engine (str): Restrict to 'raw' or 'ssvi' calibrations
+        columns (list of str): Columns to return, all columns when None
+        all_versions (bool): Also return superseded calibrations of the same snapshot
+        fname (str): Path of the .npz store
+    """
+    store = load_store(fname)
+    # snapshot column is sorted, the range is a contiguous block found by binary search
+    lo = 0 if start is None else np.searchsorted(store['snapshot'], snapshot_to_datetime64(start), side='left')
+    hi = len(store['snapshot']) if end is None else np.searchsorted(store['snapshot'], snapshot_to_datetime64(end), side='right')
+    store = {name: store[name][lo:hi] for name in store}
+
+    mask = np.ones(hi - lo, dtype='?')
+    if currency is not None:
+        mask &= store['currency'] == currency
+    if engine is not None:
+        mask &= store['engine'] == engine
+    if not all_versions:
+        mask &= latest_version_mask(store)
+
+    columns = columns or [name for name, _ in STORE_COLUMNS]
+    return {name: store[name][mask] for name in columns}
+
+
+def query_snapshot(timestamp, currency=None, engine=None, fname=store_fname):
+    return query_range(start=timestamp, end=timestamp, currency=currency, engine=engine, fname=fname)
+
+
+def rows_to_svi_param_dict(rows):
+    """
+    Converts store rows of a single snapshot into the svi_param_initial.json layout
+    """
+    return {str(rows['slice'][i]): {"t": float(rows['tau'][i]),
+                                    "A": float(rows['A'][i]),
+                                    "P": float(rows['P'][i]),
+                                    "B": float(rows['B'][i]),
+                                    "S": float(rows['S'][i]),
+                                    "M": float(rows['M'][i])}
+            for i in range(len(rows['tau']))}
@@ -0,0 +1,178 @@
+import atexit
+import functools
+import io
+import json
+import os
+import queue
+import threading
+
+import numpy as np
+import pandas as pd
+
+# Write-behind persistence: capture and calibration hand finished bytes to a single background writer thread and
+# carry on, nothing on the hot path waits for the disk. flush() is the barrier, it blocks until every queued write
+# is on disk (fsync'ed), and runs at interpreter exit. Work that is more than one file write (the locked parameter
+# store append, the surface table, the calibration cache) is queued as a job with run_behind and runs on the same
+# thread, in the order it was queued.
+#
+# A captured snapshot is stored as one compressed npz (snapshot.npz) with a typed array per column. Spot, utc_T0
+# and the currency are the same for every row and are kept once, as the snapshot metadata, instead of per row.
+
+snapshot_fname = 'snapshot.npz'
+
+# typed columns of the two tables, in the order of the Futures.csv / Options.csv they replace
+FUTURES_COLUMNS = [
+    ('instrument_names', 'U'),  # numpy picks the width of the longest name
+    ('maturities', 'i8'),  # expiration, unix milliseconds
+    ('mark_price', 'f8'),
+    ('index_price', 'f8'),
+    ('last_price', 'f8'),
+]
+OPTIONS_COLUMNS = [
+    ('type', 'U'),
+    ('strikes', 'f8'),
+    ('maturities', 'f8'),  # expiration, unix seconds
+    ('implied_volatilities', 'f8'),
+]
+
+writer_state = {'thread': None, 'dirs': set(), 'errors': []}
+write_queue = queue.Queue()
+writer_lock = threading.Lock()
+
+
+def writer_loop():
+    while True:
+        path, data = write_queue.get()
+        try:
+            if path is None:
+                data()  # a job queued by run_behind
+            else:
+                write_file(path, data() if callable(data) else data)
+        except Exception as e:
+            print(f'Background write of {path or data} failed: {e!r}')
+            writer_state['errors'].append(e)
+        finally:
+            write_queue.task_done()
+
+
+def write_file(path, data):
+    # tmp file + fsync + rename, a crash never leaves a half written file under the final name
+    folder = os.path.dirname(path) or '.'
+    os.makedirs(folder, exist_ok=True)
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    writer_state['dirs'].add(folder)
+
+
+def write_behind(path, data):
+    """
+    Queues data to be written to path by the background writer and returns immediately
+
+    Arguments:
+        path (str): Destination file, its folder is created when missing
+        data (bytes, str or callable): Complete file content, str is encoded as utf-8, a callable is called on
+            the writer thread and returns the bytes (for content that is expensive to serialize)
+    """
+    if isinstance(data, str):
+        data = data.encode()
+    start_writer()
+    write_queue.put((path, data))
+
+
+def run_behind(job, *args, **kwargs):
+    """
+    Queues job(*args, **kwargs) to run on the background writer and returns immediately, its exceptions are
+    re-raised by flush()
+
+    Arguments:
+        job (callable): Persistence work that should not hold up the caller, e.g. a locked read-modify-write
+    """
+    start_writer()
+    write_queue.put((None, functools.partial(job, *args, **kwargs)))
+
+
+def start_writer():
+    with writer_lock:
+        if writer_state['thread'] is None:
+            writer_state['thread'] = threading.Thread(target=writer_loop, name='write-behind', daemon=True)
+            writer_state['thread'].start()
+
+
+def flush():
+    """
+    Blocks until every queued write is on disk, re-raises the first failed write
+    """
+    write_queue.join()
+    # the renames are only durable once the folders holding them are synced
+    while writer_state['dirs']:
+        fd = os.open(writer_state['dirs'].pop(), os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+    if writer_state['errors']:
+        errors = writer_state['errors']
+        writer_state['errors'] = []
+        raise errors[0]
+
+
+atexit.register(flush)
+
+
+def save_snapshot(folder, currency, spot, utc_t0, futures_data, options_data):
+    """
+    Queues a captured snapshot for writing as folder/snapshot.npz
+
+    Arguments:
+        folder (str): Snapshot folder, yyyymmdd_hhmmss local time
+        currency (str): Cryptocurrency, official three-letter abbreviation
+        spot (float): Index price at capture
+        utc_t0 (datetime): UTC capture time
+        futures_data (dict or DataFrame): FUTURES_COLUMNS of the futures curve
+        options_data (dict or DataFrame): OPTIONS_COLUMNS of the option chain
+    """
+    meta = {'currency': currency,
+            'Spot': float(spot),
+            # always with microseconds, clean_up_option_data parses '%Y-%m-%d %H:%M:%S.%f'
+            'utc_T0': utc_t0.isoformat(sep=' ', timespec='microseconds')}
+    columns = {'meta': np.array(json.dumps(meta))}
+    for prefix, data, table_columns in [('futures', futures_data, FUTURES_COLUMNS),
+                                        ('options', options_data, OPTIONS_COLUMNS)]:
+        for name, dtype in table_columns:
+            columns[f'{prefix}_{name}'] = np.asarray(data[name]).astype(dtype)
+    # the caller only copies the columns, compressing is left to the writer thread
+    write_behind(os.path.join(folder, snapshot_fname), lambda: compress_columns(columns))
+
+
+def compress_columns(columns):
+    buf = io.BytesIO()
+    np.savez_compressed(buf, **columns)
+    return buf.getvalue()
+
+
+def read_snapshot(folder):
+    """
+    Returns (futures, options) DataFrames of a captured snapshot, with per row Spot and utc_T0 columns as in the
+    original csv layout. Folders captured before snapshot.npz existed are read from Futures.csv / Options.csv.
+
+    Arguments:
+        folder (str): Snapshot folder, yyyymmdd_hhmmss local time
+    """
+    path = os.path.join(folder, snapshot_fname)
+    if not os.path.exists(path):
+        futures = pd.read_csv(os.path.join(folder, 'Futures.csv'))
+        options = pd.read_csv(os.path.join(folder, 'Options.csv'))
+        return futures, options
+
+    with np.load(path, allow_pickle=False) as f:
+        meta = json.loads(str(f['meta']))
+        futures = pd.DataFrame({name: f[f'futures_{name}'] for name, _ in FUTURES_COLUMNS})
+        options = pd.DataFrame({name: f[f'options_{name}'] for name, _ in OPTIONS_COLUMNS})
+    for df in [futures, options]:
+        df['Spot'] = meta['Spot']
+        df['utc_T0'] = meta['utc_T0']
+    return futures, options
@@ -0,0 +1,79 @@
+import queue
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+
+from modules.DeribitAPI.deribit_interface import stream_deribit_data, uri as deribit_uri
+from modules.dataCleaning import clean_up_option_data, compliment_futures_in_options, select_put_call
+from modules.calibration import calibrate_maturity, save_calibration
+from modules.formulas import bsdelta
+from modules.persistence import save_snapshot
+
+
+def download(stream, events):
+    # producer thread: network only, hands every expiry over as soon as it is complete
+    try:
+        for event in stream:
+            events.put(event)
+    except BaseException as e:
+        events.put(e)
+    events.put(None)
+
+
+def pipelined_calibration(bs_delta_threshold=0.1, uri=deribit_uri):
+    """
+    Captures a Deribit snapshot and calibrates it while it is still downloading
+
+    The futures curve is fetched first, options are then streamed expiry by expiry: each expiry is cleaned
+    and calibrated on the calling thread while the next one downloads. The snapshot is handed to the background
+    writer (persistence.py) once the last expiry is in. Returns the snapshot timestamp (folder name).
+
+    Arguments:
+        bs_delta_threshold (float): Options with BS delta below the threshold are left out of the fit
+        uri (str): Endpoint for the API calls
+    """
+    capture_start = time.perf_counter()
+    events = queue.Queue()
+    producer = threading.Thread(target=download, args=(stream_deribit_data(uri=uri), events), daemon=True)
+    producer.start()
+
+    header = events.get()
+    if isinstance(header, BaseException):
+        raise header
+    timestamp = header['dateTime']
+    futures = header['futures']
+
+    svi_param = {}
+    svi_stats = {}
+    option_dfs = []
+    i = 0
+    while True:
+        option_df = events.get()
+        if option_df is None:
+            break
+        if isinstance(option_df, BaseException):
+            raise option_df
+        option_dfs.append(option_df)
+
+        # the cleaning helpers look up row 0, and compliment_futures_in_options rescales the futures it is given
+        options_slice = clean_up_option_data(option_df.reset_index(drop=True))
+        (options_slice, _) = compliment_futures_in_options(options_slice, futures.copy())
+        options_slice = select_put_call(options_slice)
+        if options_slice.empty:
+            continue
+        options_slice['MONEYNESS'] = np.log(options_slice.STRIKE / options_slice.FUTUREPRICE)
+        options_slice['BSDELTA'] = options_slice.apply(lambda x: bsdelta(x.MONEYNESS, x.IMPLIEDVOL, x.tau, x.type), axis=1)
+
+        calibrated = calibrate_maturity(timestamp, i, options_slice, bs_delta_threshold)
+        if calibrated is not None:
+            svi_param[i], svi_stats[i] = calibrated
+        i += 1
+        print(f'{time.perf_counter() - capture_start:.3f}s since capture start')
+
+    if option_dfs:
+        save_snapshot(timestamp, header['currency'], header['spot'], header['utc_T0'], futures, pd.concat(option_dfs))
+    save_calibration(timestamp, header['currency'], svi_param, svi_stats, publish=True)
+    print(f"Pipelined capture and calibration took {time.perf_counter() - capture_start:.3f}s against {uri}")
+    return timestamp
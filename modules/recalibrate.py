@@ -12,6 +12,12 @@ import math as mth
 from mpl_toolkits.mplot3d import Axes3D
 import scipy as sp
 from matplotlib.backends.backend_pdf import PdfPages
+import os
+import sys
+if not __package__:
+    # run as a script (python modules/recalibrate.py), make the repository root importable for modules.*
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from modules.formulas import straightSVI, straightSVIp, straightSVIpp
 
 # Do logging to stdout
 def log(*ss):
@@ -67,17 +73,7 @@ def BlackScholes(type, S0, K, r, sigma, T, q):
 def rawSVI(k,a,b,rho,m,sigma):
     return a+b*(rho*(k-m)+np.sqrt((k-m)**2+sigma**2))
 
-# Hyperbola asymptotes parametrisation
-def straightSVI(x,m1,m2,q1,q2,c):
-    return ((m1+m2)*x+q1+q2+np.sqrt(((m1+m2)*x+q1+q2)**2-4*(m1*m2*x**2+(m1*q2+m2*q1)*x+q1*q2-c)))/2
-def straightSVIp(x,m1,m2,q1,q2,c):
-    H=np.sqrt(((m1+m2)*x+q1+q2)**2-4*(m1*m2*x**2+(m1*q2+m2*q1)*x+q1*q2-c))
-    return ((m1+m2)+((m1+m2)*((m1+m2)*x+q1+q2)-4*m1*m2*x-2*(m1*q2+m2*q1))/H)/2
-def straightSVIpp(x,m1,m2,q1,q2,c):
-    H=np.sqrt(((m1+m2)*x+q1+q2)**2-4*(m1*m2*x**2+(m1*q2+m2*q1)*x+q1*q2-c))
-    A=(2*(m1+m2)**2-8*m1*m2)/H
-    B=(2*(m1+m2)*((m1+m2)*x+q1+q2)-8*m1*m2*x-4*(m1*q2+m2*q1))**2/H**3/2
-    return (A-B)/4
+# Hyperbola asymptotes parametrisation (straightSVI, straightSVIp, straightSVIpp) lives in modules.formulas
 
 # Alternative parametrisation including the parabola
 def stdSVI(x,a0,a1,a2,a3,a4):
@@ -120,6 +116,11 @@ bpen    = 128                # initial butterfly penalty factor
 cpen    = 128                # initial calendar penalty factor
 blim    = 0.001              # target butterfly arbitrage bound
 clim    = 0.001              # target calendar arbitrage bound
+ncoarse = 17                 # initial number of arbitrage check points per slice
+nrefine = 5                  # bisection passes refining the check grid near violation boundaries
+maxcheck= 48                 # cap on the number of arbitrage check points per slice
+gtol    = 0.05               # butterfly: refine where |g(k)| < gtol or g changes sign
+ctol    = 0.05               # calendar: refine where |w1-w2| < ctol times the total variance or w1-w2 changes sign
 
 # Read raw data
 log('Reading raw data ...')
@@ -147,6 +148,12 @@ expirs = sorted(set(data['Expiration']))
 strikes = sorted(set(data['Strike']))
 grid=pd.DataFrame(index=strikes)
 for T in expirs: grid[T]=[logstrike(K,T) for K in strikes]
+# The penalties are checked on an adaptive grid in log-strike instead: it starts coarse over the listed strikes
+# and is bisected only where the checked quantity gets close to zero. Each check point is weighted by the
+# log-strike width it stands for in units of the mean dense grid spacing, so the penalty sums stay comparable
+# with blim and clim whatever the number of points.
+logK=np.log(strikes)
+dlogK=(logK[-1]-logK[0])/max(len(strikes)-1,1)
 
 # Variable to store parameter vectors chi
 chi=pd.DataFrame(index=expirs,columns=['m1','m2','q1','q2','c'])
@@ -192,20 +199,50 @@ for T in expirs:
     log('Got parameters:',chi.loc[T,:])
 log('Summary of initial guess for parameters:',chi)
 
-# Function to quantify calendar arbitrage between two slices T1 > T2 on grid
+# Refine a grid of log-strikes u where f(u) comes within tol of zero or changes sign (f<0 is a violation),
+# returns the points, the values of f and the weight of each point
+def adaptive(f,tol):
+    u=np.linspace(logK[0],logK[-1],ncoarse)
+    v=f(u)
+    for i in range(nrefine):
+        # only the boundaries of a violated region move with the parameters, its interior is covered by the weights
+        near=np.abs(v)<tol
+        split=near[:-1] | near[1:] | (np.sign(v[:-1])!=np.sign(v[1:]))
+        um=(u[:-1]+u[1:])[split][:maxcheck-len(u)]/2.
+        if len(um)==0: break
+        u=np.concatenate([u,um])
+        v=np.concatenate([v,f(um)])
+        order=np.argsort(u)
+        u,v=u[order],v[order]
+    du=np.diff(u)
+    weight=(np.concatenate([du,[0]])+np.concatenate([[0],du]))/2./dlogK
+    return u,v,weight
+
+# Asymptotic slopes of the total variance, left (k -> -inf) and right (k -> +inf) wing
+def wings(chi): return min(chi[0],chi[1]),max(chi[0],chi[1])
+
+# Function to quantify calendar arbitrage between two slices T1 > T2 on the adaptive grid
 def calendar(chi1,T1,chi2,T2):
     if T2==0 or T1<=T2: return 0
-    w1=[straightSVI(k,chi1[0],chi1[1],chi1[2],chi1[3],chi1[4]) for k in grid[T1]]
-    w2=[straightSVI(k,chi2[0],chi2[1],chi2[2],chi2[3],chi2[4]) for k in grid[T2]]
-    return sum([np.maximum(0,x2-x1) for x1,x2 in zip(w1,w2)])
-
-# Function to quantify butterfly arbitrage in a slice on grid
+    chi1=np.asarray(chi1,dtype=float); chi2=np.asarray(chi2,dtype=float)
+    w1=lambda u: straightSVI(u-np.log(S0)-(r-q)*T1,*chi1)
+    w2=lambda u: straightSVI(u-np.log(S0)-(r-q)*T2,*chi2)
+    u,v,weight=adaptive(lambda u: w1(u)-w2(u),ctol*np.mean(w2(logK[[0,-1]])))
+    # analytic wing check: the later slice needs the steeper wings
+    (l1,r1),(l2,r2)=wings(chi1),wings(chi2)
+    return np.sum(weight*np.maximum(0,-v))+np.maximum(0,r2-r1)+np.maximum(0,l1-l2)
+
+# Function to quantify butterfly arbitrage in a slice on the adaptive grid
 def butterfly(chi,T):
-    w=np.array([straightSVI(k,chi[0],chi[1],chi[2],chi[3],chi[4]) for k in grid[T]])
-    wp=np.array([straightSVIp(k,chi[0],chi[1],chi[2],chi[3],chi[4]) for k in grid[T]])
-    wpp=np.array([straightSVIpp(k,chi[0],chi[1],chi[2],chi[3],chi[4]) for k in grid[T]])
-    g=(1.-(grid[T]*wp)/(2.*w))**2-wp**2/4.*(1./w+1./4.)+wpp/2.
-    return sum([np.maximum(0,-x) for x in g])
+    chi=np.asarray(chi,dtype=float)
+    def g(u):
+        k=u-np.log(S0)-(r-q)*T
+        w=straightSVI(k,*chi); wp=straightSVIp(k,*chi); wpp=straightSVIpp(k,*chi)
+        return (1.-(k*wp)/(2.*w))**2-wp**2/4.*(1./w+1./4.)+wpp/2.
+    u,v,weight=adaptive(g,gtol)
+    # analytic wing check: Lee's moment formula bounds the wing slopes by 2
+    left,right=wings(chi)
+    return np.sum(weight*np.maximum(0,-v))+np.maximum(0,right-2)+np.maximum(0,-2-left)
 
 # Residuals function for fitting option prices with penalties on arbitrage
 def residuals(chiT,T,Tp):
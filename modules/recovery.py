@@ -0,0 +1,144 @@
+import atexit
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, wait
+
+import numpy as np
+from scipy import optimize
+
+from modules.formulas import get_backend, set_backend, solve_grad, solve_grad_get_score
+
+# Recovery of slices on which calibrate() fails: the Zeliade objective is scored for a whole grid of (S, M)
+# starting points in one vectorized pass, and only the most promising starts are refined, in parallel.
+
+n_starts = 24  # grid size along S and along M, n_starts ** 2 candidates scored at once
+n_refine = 4  # best candidates refined with the optimizer
+min_points = 5  # fewer quotes above the delta cutoff than this and the cutoff is relaxed
+relaxed_points = 8  # quotes fitted by the relaxed cutoff, more than the 5 SVI parameters so it is not interpolation
+time_budget = 5.0  # seconds allowed for the recovery of one slice
+
+refine_pool = {}
+
+
+def init_worker(backend):
+    # loads (and for numba compiles) the kernels once per worker, before any refinement is timed
+    set_backend(backend)
+
+
+def get_pool():
+    """
+    Returns the refinement pool, started and warmed up on first use so no slice's time budget pays for it
+    """
+    if refine_pool.get('backend') != get_backend():
+        if 'pool' in refine_pool:
+            refine_pool['pool'].shutdown(wait=False, cancel_futures=True)
+        # no fork: the write-behind and download threads may be running, forking them can deadlock the workers
+        method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+        n_workers = min(n_refine, os.cpu_count() or 1)
+        pool = ProcessPoolExecutor(max_workers=n_workers, mp_context=multiprocessing.get_context(method),
+                                   initializer=init_worker, initargs=(get_backend(),))
+        wait([pool.submit(os.getpid) for _ in range(n_workers)])
+        if 'pool' not in refine_pool:
+            atexit.register(lambda: refine_pool['pool'].shutdown(wait=False, cancel_futures=True))
+        refine_pool['pool'], refine_pool['backend'] = pool, get_backend()
+    return refine_pool['pool']
+
+
+def batch_score(S, M, x, vT):
+    """
+    Returns the sum of squares of the best (a, d, c) for every (S, M) pair at once, (a, d, c) clamped into
+    Zeliade's domain so every score belongs to an admissible slice
+    """
+    ys = (x[None, :] - M[:, None]) / S[:, None]
+    r = np.sqrt(ys * ys + 1)
+    y, y2, ysqrt, y2sqrt = ys.sum(1), (ys * ys).sum(1), r.sum(1), (ys * r).sum(1)
+    v, vy, vsqrt = np.full(len(S), vT.sum()), ys @ vT, r @ vT
+    matrix = np.stack([np.stack([np.ones(len(S)), y, ysqrt], -1),
+                       np.stack([y, y2, y2sqrt], -1),
+                       np.stack([ysqrt, y2sqrt, y2 + len(x)], -1)], -2)
+    a, d, c = (np.linalg.pinv(matrix) @ np.stack([v, vy, vsqrt], -1)[..., None])[..., 0].T
+    c = np.clip(c, 0, 4 * S)
+    dmax = np.minimum(c, 4 * S - c)
+    d = np.clip(d, -dmax, dmax)
+    a = np.clip(a, 0, vT.max())
+    diff = a[:, None] + d[:, None] * ys + c[:, None] * r - vT[None, :]
+    return (diff * diff).sum(1)
+
+
+def refine_start(S0, M0, x, vT, deadline):
+    # deadline is wall clock (time.time()), the objective gives up once it has passed so no worker outlives the budget
+    def score(SM, args):
+        if time.time() > deadline:
+            raise TimeoutError
+        return solve_grad_get_score(SM, args)
+
+    work = np.empty((2, len(x)))
+    try:
+        res = optimize.minimize(score, [S0, M0], args=[x, vT, work], bounds=[(0.001, None), (None, None)])
+        if not res.success:
+            return None
+        S, M = res.x
+        a, d, c, cost = solve_grad(S, M, x, vT, work)
+        return cost, S, M, a, d, c, int(res.nfev), int(res.nit)
+    except (AssertionError, ValueError, np.linalg.LinAlgError, TimeoutError):
+        return None
+
+
+def multistart(x, vT, deadline):
+    S = np.geomspace(0.005, 2.0, n_starts)
+    M = np.linspace(x.min() - 0.1, x.max() + 0.1, n_starts)
+    S, M = (a.ravel() for a in np.meshgrid(S, M))
+    score = batch_score(S, M, x, vT)
+    best = np.argsort(score)[:n_refine]
+
+    pool = get_pool()
+    remaining = max(deadline - time.perf_counter(), 0)
+    futures = [pool.submit(refine_start, S[i], M[i], x, vT, time.time() + remaining) for i in best]
+    done, not_done = wait(futures, timeout=remaining)
+    for f in not_done:
+        f.cancel()  # queued ones are dropped, running ones stop at their own deadline, their results are ignored
+    results = [r for r in (f.result() for f in done) if r is not None]
+    if not done:
+        # the pool did not answer in time (busy or overloaded machine), refine the best start here instead
+        results = [r for r in [refine_start(S[best[0]], M[best[0]], x, vT, time.time() + time_budget)] if r is not None]
+    return min(results, key=lambda r: r[0]) if results else None
+
+
+def recover_calibration(curve, bs_delta_threshold):
+    """
+    Second attempt at a slice calibrate() failed on, returns (A, P, B, S, M, stats) like calibrate(return_stats=True)
+    with stats["strategy"] naming the strategy that succeeded, raises ValueError otherwise
+
+    Arguments:
+        curve (DataFrame): Slice with MONEYNESS, IMPLIEDVOL, tau and BSDELTA columns
+        bs_delta_threshold (float): BS delta cutoff used by the failed calibration
+    """
+    get_pool()  # pool start up and worker imports are not part of the budget
+    deadline = time.perf_counter() + time_budget
+    fit_curve = curve[curve.BSDELTA > bs_delta_threshold]
+    strategies = []
+    if len(fit_curve) >= 3:
+        strategies.append(('multistart', fit_curve))
+    if len(fit_curve) < min_points and len(curve) >= relaxed_points:
+        # short expiries often have (almost) nothing above the cutoff, take the highest delta quotes instead
+        strategies.append(('relaxed-threshold', curve.sort_values('BSDELTA').iloc[-relaxed_points:]))
+
+    for strategy, df in strategies:
+        if time.perf_counter() > deadline:
+            break
+        x = df.MONEYNESS.to_numpy(dtype=np.float64)
+        vT = (df.IMPLIEDVOL * df.IMPLIEDVOL * df.tau).to_numpy(dtype=np.float64)
+        best = multistart(x, vT, deadline)
+        if best is None:
+            continue
+        _, S, M, a, d, c, nfev, nit = best
+        T = df.tau.max()
+        A, P, B = a / T, d / c, c / (S * T)
+        vol = np.sqrt(A + B * (P * (x - M) + np.sqrt((x - M) * (x - M) + S * S)))
+        rmse = np.sqrt(np.mean((vol - df.IMPLIEDVOL.to_numpy()) ** 2))
+        # a relaxed fit uses quotes below the requested cutoff, flagged so downstream users can leave it out
+        stats = {"rmse": float(rmse), "nfev": nfev, "nit": nit, "success": strategy != 'relaxed-threshold',
+                 "strategy": strategy}
+        return A, P, B, S, M, stats
+    raise ValueError(f"no recovery strategy succeeded for t={curve.tau.max()}")
@@ -0,0 +1,100 @@
+import numpy as np
+from scipy import optimize
+
+# Surface SVI (Gatheral & Jacquier, "Arbitrage-free SVI volatility surfaces"):
+#   w(k, theta) = theta / 2 * (1 + rho * phi * k + sqrt((phi * k + rho) ** 2 + 1 - rho ** 2))
+# with the power-law phi(theta) = eta * theta ** -gamma * (1 + theta) ** (gamma - 1).
+# The surface is free of static arbitrage when theta is non-decreasing in t, gamma in (0, 1/2]
+# and eta * (1 + |rho|) <= 2, so the parameters below are chosen to make that hold by construction:
+#   theta_i = d_0 + ... + d_i with d_j >= 0, eta = 2 * e / (1 + |rho|) with e in (0, 1].
+
+
+def ssvi_phi(theta, eta, gamma):
+    return eta * theta ** (-gamma) * (1 + theta) ** (gamma - 1)
+
+
+def ssvi_total_variance(k, theta, rho, eta, gamma):
+    phi = ssvi_phi(theta, eta, gamma)
+    return theta / 2 * (1 + rho * phi * k + np.sqrt((phi * k + rho) ** 2 + 1 - rho * rho))
+
+
+def unpack_params(params, n):
+    d = params[:n]
+    rho, e, gamma = params[n:]
+    theta = np.cumsum(d)
+    eta = 2 * e / (1 + abs(rho))
+    return theta, rho, e, eta, gamma
+
+
+def ssvi_residuals(params, k, iv, tau, slice_idx, n):
+    theta, rho, _, eta, gamma = unpack_params(params, n)
+    w = ssvi_total_variance(k, theta[slice_idx], rho, eta, gamma)
+    return np.sqrt(w / tau) - iv
+
+
+def ssvi_jacobian(params, k, iv, tau, slice_idx, n):
+    theta, rho, e, eta, gamma = unpack_params(params, n)
+    th = theta[slice_idx]
+    phi = ssvi_phi(th, eta, gamma)
+    R = np.sqrt(phi * phi * k * k + 2 * rho * phi * k + 1)
+    w = th / 2 * (1 + rho * phi * k + R)
+
+    dr_dw = 1 / (2 * np.sqrt(w * tau))
+    dw_dphi = th / 2 * (rho * k + (phi * k * k + rho * k) / R)
+    dphi_dtheta = phi * (-gamma / th + (gamma - 1) / (1 + th))
+    dw_dtheta = w / th + dw_dphi * dphi_dtheta
+    deta_drho = -2 * e * np.sign(rho) / (1 + abs(rho)) ** 2
+
+    jac = np.empty((len(k), n + 3))
+    # theta_i depends on every increment d_j with j <= i
+    jac[:, :n] = (dr_dw * dw_dtheta)[:, None] * (slice_idx[:, None] >= np.arange(n)[None, :])
+    jac[:, n] = dr_dw * (th / 2 * phi * k * (1 + 1 / R) + dw_dphi * phi / eta * deta_drho)
+    jac[:, n + 1] = dr_dw * dw_dphi * phi / eta * 2 / (1 + abs(rho))
+    jac[:, n + 2] = dr_dw * dw_dphi * phi * (np.log(1 + th) - np.log(th))
+    return jac
+
+
+def calibrate_ssvi(df):
+    """
+    Fits one SSVI surface to all slices at once, returns the surface parameters and the solver result
+
+    Arguments:
+        df (DataFrame): Quotes with MONEYNESS, IMPLIEDVOL and tau columns (tau > 0), any number of maturities
+    """
+    taus, slice_idx = np.unique(df.tau.to_numpy(), return_inverse=True)
+    n = len(taus)
+    k = df.MONEYNESS.to_numpy(dtype=float)
+    iv = df.IMPLIEDVOL.to_numpy(dtype=float)
+    tau = df.tau.to_numpy(dtype=float)
+
+    # start from the at-the-money total variance of every slice, made non-decreasing
+    theta0 = np.empty(n)
+    for i in range(n):
+        in_slice = slice_idx == i
+        order = np.argsort(k[in_slice])
+        theta0[i] = np.interp(0, k[in_slice][order], (iv * iv * tau)[in_slice][order])
+    theta0 = np.maximum.accumulate(np.maximum(theta0, 1e-6))
+    d0 = np.diff(theta0, prepend=0)
+    x0 = np.concatenate([np.maximum(d0, 1e-6), [-0.3, 0.5, 0.4]])
+
+    lower = np.concatenate([np.full(n, 1e-8), [-0.999, 1e-6, 1e-3]])
+    upper = np.concatenate([np.full(n, np.inf), [0.999, 1.0, 0.5]])
+    res = optimize.least_squares(ssvi_residuals, x0, jac=ssvi_jacobian, bounds=(lower, upper),
+                                 args=(k, iv, tau, slice_idx, n), method='trf', x_scale='jac')
+    assert res.success
+    theta, rho, _, eta, gamma = unpack_params(res.x, n)
+    rmse = np.sqrt(np.bincount(slice_idx, weights=res.fun * res.fun) / np.bincount(slice_idx))
+    return {"tau": taus, "theta": theta, "rho": rho, "eta": eta, "gamma": gamma, "rmse": rmse}, res
+
+
+def ssvi_to_raw(theta, rho, eta, gamma, tau):
+    """
+    Returns the raw SVI parameters (A, P, B, S, M) of the SSVI slice with ATM total variance theta at maturity tau,
+    in the variance (not total variance) convention used by svi()
+    """
+    phi = ssvi_phi(theta, eta, gamma)
+    a = theta / 2 * (1 - rho * rho)
+    b = theta * phi / 2
+    M = -rho / phi
+    S = np.sqrt(1 - rho * rho) / phi
+    return a / tau, rho, b / tau, S, M
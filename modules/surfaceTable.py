@@ -0,0 +1,164 @@
+import mmap
+import os
+import time
+import numpy as np
+
+from modules.formulas import svi
+
+# Precomputed total variance surface w(k, tau), uniform in log-moneyness and with the calibrated slice maturities as
+# the tau knots, published as one memory-mapped file so any number of reader processes share a single physical copy
+# through the page cache.
+# Layout: 64 byte header (HEADER_DTYPE), float64 tau[nt] knots, float64 w[nt, nk] in C order.
+
+HEADER_DTYPE = np.dtype([
+    ('magic', 'S8'),
+    ('version', '<u8'),
+    ('nk', '<u4'),
+    ('nt', '<u4'),
+    ('k0', '<f8'),
+    ('dk', '<f8'),
+    ('created', '<f8'),
+    ('snapshot', 'S16'),  # snapshot folder name (yyyymmdd_hhmmss) the surface was calibrated on
+])
+MAGIC = b'SVILUT2'
+surface_fname = '/dev/shm/svi_surface.lut' if os.path.isdir('/dev/shm') else 'svi_surface.lut'
+
+
+def evaluate_surface(svi_param_dict, k_min=-2.0, k_max=2.0, nk=401):
+    """
+    Returns the total variance grid of the calibrated slices and its axes (k, tau, w[nt, nk]), one row per slice.
+    Slices where SVI is undefined somewhere on the grid (negative variance) are left out rather than published
+
+    Arguments:
+        svi_param_dict (dict): Slices in the svi_param_initial.json layout
+        k_min, k_max (float): Log-moneyness range
+        nk (int): Number of grid points along log-moneyness
+    """
+    slices = sorted((p for p in svi_param_dict.values() if p["t"] > 0), key=lambda p: p["t"])
+    if not slices:
+        raise ValueError("No calibrated slice with positive maturity to export")
+    k = np.linspace(k_min, k_max, nk)
+    slice_tau = np.array([p["t"] for p in slices])
+    slice_w = np.array([svi(p["A"], p["P"], p["B"], p["S"], p["M"], k) ** 2 * p["t"] for p in slices])
+    defined = np.isfinite(slice_w).all(axis=1)
+    for tau in slice_tau[~defined]:
+        print(f'SVI slice t={tau} is undefined on [{k_min}, {k_max}], left out of the surface table')
+    if not defined.any():
+        raise ValueError(f"No slice with SVI defined on [{k_min}, {k_max}] to export")
+    return k, slice_tau[defined], slice_w[defined]
+
+
+def publish_surface(svi_param_dict, snapshot, path=surface_fname, force=False, **grid_kwargs):
+    """
+    Evaluates the surface and atomically replaces the table at path, returns the new version number, or None when
+    the table already holds a newer snapshot
+
+    Readers attached to the previous version keep a valid mapping of it until they refresh.
+
+    Arguments:
+        svi_param_dict (dict): Slices in the svi_param_initial.json layout
+        snapshot (str): Snapshot folder the slices were calibrated on, yyyymmdd_hhmmss
+        path (str): Table to replace
+        force (bool): Replace the table even if it holds a newer snapshot
+    """
+    snapshot = os.path.basename(os.path.normpath(snapshot))
+    previous = None
+    if os.path.exists(path):
+        try:
+            previous = read_header(path)
+        except ValueError:
+            pass  # older layout, simply replaced
+    if previous is not None and not force and previous['snapshot'].decode() > snapshot:
+        # backfills and reruns of archived snapshots must not replace the live surface
+        print(f'{path} holds the newer snapshot {previous["snapshot"].decode()}, not replaced by {snapshot}')
+        return None
+
+    k, tau, w = evaluate_surface(svi_param_dict, **grid_kwargs)
+    header = np.zeros(1, dtype=HEADER_DTYPE)
+    header['magic'] = MAGIC
+    header['version'] = 0 if previous is None else int(previous['version']) + 1
+    header['nk'], header['nt'] = len(k), len(tau)
+    header['k0'], header['dk'] = k[0], k[1] - k[0]
+    header['created'] = time.time()
+    header['snapshot'] = snapshot.encode()[:16]
+
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(header.tobytes())
+        f.write(np.ascontiguousarray(tau, dtype='<f8').tobytes())
+        f.write(np.ascontiguousarray(w, dtype='<f8').tobytes())
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    print(f'Published SVI surface version {int(header["version"][0])} of {snapshot} to {path}')
+    return int(header['version'][0])
+
+
+def read_header(path):
+    with open(path, 'rb') as f:
+        header = np.frombuffer(f.read(HEADER_DTYPE.itemsize), dtype=HEADER_DTYPE)[0]
+    if header['magic'] != MAGIC:
+        raise ValueError(f'{path} is not an SVI surface table')
+    return header
+
+
+def attach_surface(path=surface_fname):
+    """
+    Maps the published table read-only, no copy and no parsing beyond the fixed header
+
+    Returns a dictionary with the header fields, the tau[nt] and w[nt, nk] views and the inode used by refresh_surface.
+    """
+    with open(path, 'rb') as f:
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        inode = os.fstat(f.fileno()).st_ino
+    header = np.frombuffer(buf, dtype=HEADER_DTYPE, count=1)[0]
+    if header['magic'] != MAGIC:
+        raise ValueError(f'{path} is not an SVI surface table')
+    nk, nt = int(header['nk']), int(header['nt'])
+    tau = np.frombuffer(buf, dtype='<f8', count=nt, offset=HEADER_DTYPE.itemsize)
+    w = np.frombuffer(buf, dtype='<f8', count=nk * nt, offset=HEADER_DTYPE.itemsize + tau.nbytes).reshape(nt, nk)
+    return {'path': path, 'inode': inode, 'version': int(header['version']), 'snapshot': header['snapshot'].decode(),
+            'k0': float(header['k0']), 'dk': float(header['dk']), 'nk': nk, 'nt': nt, 'tau': tau, 'w': w}
+
+
+def refresh_surface(table):
+    # re-attach only if the publisher swapped in a new file since this table was attached
+    if os.stat(table['path']).st_ino != table['inode']:
+        return attach_surface(table['path'])
+    return table
+
+
+def surface_total_variance(table, k, tau):
+    """
+    Bilinear interpolation of the total variance at log-moneyness k and maturity tau (scalars or arrays)
+
+    Between the slice maturities the total variance is linear in tau, so the calibrated slices are reproduced exactly
+    at their own maturity. Log-moneyness is clamped to the grid, maturities outside the calibrated range keep the
+    implied vol of the nearest slice.
+    """
+    k = np.asarray(k, dtype=np.float64)
+    tau = np.asarray(tau, dtype=np.float64)
+    w = table['w']
+
+    xk = np.clip((k - table['k0']) / table['dk'], 0, table['nk'] - 1)
+    ik = np.minimum(xk.astype(np.intp), table['nk'] - 2)
+    fk = xk - ik
+
+    knots = table['tau']
+    tau_c = np.clip(tau, knots[0], knots[-1])
+    if table['nt'] > 1:
+        it = np.clip(np.searchsorted(knots, tau_c, side='right') - 1, 0, table['nt'] - 2)
+        ft = (tau_c - knots[it]) / (knots[it + 1] - knots[it])
+    else:
+        it = np.zeros_like(ik)
+        ft = np.zeros_like(fk)
+    it1 = np.minimum(it + 1, table['nt'] - 1)
+
+    w_lo = (1 - fk) * w[it, ik] + fk * w[it, ik + 1]
+    w_hi = (1 - fk) * w[it1, ik] + fk * w[it1, ik + 1]
+    w_c = (1 - ft) * w_lo + ft * w_hi
+    return w_c * tau / tau_c  # constant implied vol beyond the tau grid
+
+
+def surface_vol(table, k, tau):
+    return np.sqrt(surface_total_variance(table, k, tau) / tau)
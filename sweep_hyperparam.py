@@ -0,0 +1,144 @@
+import argparse
+import itertools
+import os
+import time
+import multiprocessing
+from multiprocessing import shared_memory
+
+import numpy as np
+import pandas as pd
+
+from modules.calibCache import cached_calibrate
+from modules.calibration import penalty_refit
+from modules.dataRetrieval import retrieve_data_source
+from modules.formulas import bsdelta
+from modules.jointRefit import raw_svi_total_variance
+from main import restricted_float
+
+# Sweep the calibration hyperparameters (calib_hyperparameter.json) and the bs delta cutoff over a grid,
+# loading and cleaning the snapshot once and sharing it read-only with a pool of worker processes.
+# The initial per-slice fits only depend on the cutoff, they are done once per cutoff in the parent, through the
+# same cache and recovery as the production path, and only the penalized refits fan out.
+# python sweep_hyperparam.py -t 20220416_143702 --bsthres 0.05,0.1,0.2 --bpen 32,128 --cpen 32,128 -w 4
+
+chain_columns = ['tau', 'MONEYNESS', 'IMPLIEDVOL', 'BSDELTA']
+shared_chain = {}
+
+
+def attach_chain(shm_name, shape):
+    # pool initializer: map the cleaned chain once per worker, no copy
+    shm = shared_memory.SharedMemory(name=shm_name)
+    chain = np.ndarray(shape, dtype=np.float64, buffer=shm.buf)
+    chain.flags.writeable = False
+    shared_chain['shm'] = shm
+    shared_chain['df'] = pd.DataFrame(chain, columns=chain_columns, copy=False)
+
+
+def fit_rmse(df, svi_param_dict):
+    taus = np.array(sorted(svi_param_dict))
+    df = df[np.isclose(df.tau.to_numpy()[:, None], taus[None, :]).any(axis=1)]
+    if df.empty:
+        return np.nan
+    params = np.array([[svi_param_dict[t][name] for name in ["A", "P", "B", "S", "M"]] for t in taus])
+    tau = df.tau.to_numpy()
+    slice_idx = np.abs(tau[:, None] - taus[None, :]).argmin(axis=1)
+    w, _, _ = raw_svi_total_variance(params[slice_idx], df.MONEYNESS.to_numpy(), tau)
+    return float(np.sqrt(np.mean((np.sqrt(np.maximum(w, 0) / tau) - df.IMPLIEDVOL.to_numpy()) ** 2)))
+
+
+def initial_fit(options_df, bs_delta_threshold):
+    # per-slice fits as in calibrate_maturity, returns ({tau: {A, P, B, S, M}}, summary columns of the results row)
+    start = time.perf_counter()
+    svi_param_dict = {}
+    n_failed = 0
+    n_relaxed = 0
+    for t in options_df.tau.unique():
+        curve = options_df[options_df.tau == t].sort_values('MONEYNESS')
+        try:
+            A, P, B, S, M, stats = cached_calibrate(curve, bs_delta_threshold)
+        except (AssertionError, ValueError, np.linalg.LinAlgError):
+            n_failed += 1
+            continue
+        svi_param_dict[float(t)] = {"A": A, "P": P, "B": B, "S": S, "M": M}
+        n_relaxed += not stats.get("success", True)
+    fit_df = options_df[options_df.BSDELTA > bs_delta_threshold]
+    return svi_param_dict, {"n_slices": len(svi_param_dict),
+                            "n_failed": n_failed,
+                            "n_relaxed": n_relaxed,
+                            "initial_rmse": fit_rmse(fit_df, svi_param_dict),
+                            "initial_seconds": time.perf_counter() - start}
+
+
+def run_combination(combination):
+    bs_delta_threshold, h_params, svi_param_dict, initial = combination
+    options_df = shared_chain['df']
+    start = time.perf_counter()
+
+    final = dict(h_params)
+    rounds = 0
+    if svi_param_dict:
+        (final, svi_param_dict, rounds) = penalty_refit(options_df, bs_delta_threshold, dict(h_params), svi_param_dict)
+    fit_df = options_df[options_df.BSDELTA > bs_delta_threshold]
+    # bpen / cpen are the grid inputs, penalty_refit doubles them on every extra round
+    return {"bsthres": bs_delta_threshold,
+            **{name: h_params[name] for name in ["bpen", "cpen", "blim", "clim"]},
+            **initial,
+            "refit_rmse": fit_rmse(fit_df, svi_param_dict),
+            "butarb": final["butarb"],
+            "calarb": final["calarb"],
+            "rounds": rounds,
+            "final_bpen": final["bpen"],
+            "final_cpen": final["cpen"],
+            "seconds": time.perf_counter() - start}
+
+
+def float_list(x):
+    return [float(v) for v in x.split(',')]
+
+
+def delta_list(x):
+    # same validation as main.py -bsthres, each cutoff is a float in [0, 1]
+    return [restricted_float(v) for v in x.split(',')]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-t", "--timestamp", type=str, required=True,
+                        help="stored snapshot to sweep on, in yyyymmdd_hhmmss")
+    parser.add_argument("--bsthres", type=delta_list, default=[0.1], help="comma separated bs delta cutoffs")
+    parser.add_argument("--bpen", type=float_list, default=[128], help="comma separated initial butterfly penalty factors")
+    parser.add_argument("--cpen", type=float_list, default=[128], help="comma separated initial calendar penalty factors")
+    parser.add_argument("--blim", type=float_list, default=[0.001], help="comma separated butterfly arbitrage bounds")
+    parser.add_argument("--clim", type=float_list, default=[0.001], help="comma separated calendar arbitrage bounds")
+    parser.add_argument("-w", "--workers", type=int, default=os.cpu_count(), help="number of worker processes")
+    parser.add_argument("-o", "--output", type=str, help="results csv, default <timestamp>/hyperparam_sweep.csv")
+    args = parser.parse_args()
+
+    # load, clean and prepare the snapshot once
+    options_df, _ = retrieve_data_source(args.timestamp)
+    options_df['MONEYNESS'] = np.log(options_df.STRIKE / options_df.FUTUREPRICE)
+    options_df['BSDELTA'] = options_df.apply(lambda x: bsdelta(x.MONEYNESS, x.IMPLIEDVOL, x.tau, x.type), axis=1)
+    chain = np.ascontiguousarray(options_df[chain_columns].to_numpy(dtype=np.float64))
+    initial_fits = {bs: initial_fit(options_df[chain_columns], bs) for bs in args.bsthres}
+
+    shm = shared_memory.SharedMemory(create=True, size=chain.nbytes)
+    try:
+        np.ndarray(chain.shape, dtype=np.float64, buffer=shm.buf)[:] = chain
+        combinations = [(bs, {"butarb": float("Inf"), "calarb": float("Inf"),
+                              "bpen": bpen, "cpen": cpen, "blim": blim, "clim": clim}, *initial_fits[bs])
+                        for bs, bpen, cpen, blim, clim in itertools.product(args.bsthres, args.bpen, args.cpen,
+                                                                             args.blim, args.clim)]
+        print(f'Sweeping {len(combinations)} combinations on {args.workers} workers')
+        # forkserver workers start from a clean interpreter, not a fork of this one and its write-behind thread
+        context = multiprocessing.get_context('forkserver')
+        with context.Pool(processes=args.workers, initializer=attach_chain,
+                          initargs=(shm.name, chain.shape)) as pool:
+            results = pd.DataFrame(pool.map(run_combination, combinations, chunksize=1))
+    finally:
+        shm.close()
+        shm.unlink()
+
+    output = args.output or os.path.join(args.timestamp, 'hyperparam_sweep.csv')
+    results.to_csv(output, index=False)
+    print(results.to_string(index=False))
+    print(f'Saved sweep results to {output}')
@@ -0,0 +1,47 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('numba')
+
+from modules.formulas import load_backend
+
+# every kernel of the numba backend against the numpy reference, on the same random inputs
+
+rng = np.random.default_rng(0)
+x = np.sort(rng.uniform(-1.5, 1.5, 257))
+vT = 0.04 + 0.1 * (x - 0.1) ** 2 + rng.uniform(0, 0.005, len(x))
+chi = (-0.4, 0.6, 0.05, 0.03, 0.002)  # m1 < 0 < m2, c > 0
+
+cases = [
+    ('svi', (0.04, -0.3, 0.5, 0.2, 0.05, x)),
+    ('svi', (0.04, -0.3, 0.5, 0.2, 0.05, 0.1)),
+    ('sum_of_squares', (x, 0.01, -0.02, 0.05, vT)),
+    *[('solve_grad', (S, M, x, vT)) for S, M in [(0.1, 0.0), (0.3, 0.2), (0.05, -0.5), (2.0, 1.0)]],
+    *[('bsdelta', (m, v, t, o)) for m in (-0.5, 0.0, 0.3) for v in (0.2, 0.9) for t in (0.0, 0.1, 1.0)
+      for o in ('call', 'put')],
+    ('straightSVI', (x, *chi)),
+    ('straightSVIp', (x, *chi)),
+    ('straightSVIpp', (x, *chi)),
+]
+
+
+@pytest.mark.parametrize('name, args', cases)
+def test_numba_matches_numpy(name, args):
+    reference = np.atleast_1d(np.asarray(load_backend('numpy')[name](*args), dtype=np.float64))
+    candidate = np.atleast_1d(np.asarray(load_backend('numba')[name](*args), dtype=np.float64))
+    assert candidate.shape == reference.shape
+    np.testing.assert_allclose(candidate, reference, rtol=1e-9, atol=1e-9)
+
+
+def test_scalar_in_scalar_out():
+    assert np.ndim(load_backend('numba')['svi'](0.04, -0.3, 0.5, 0.2, 0.05, 0.1)) == 0
+
+
+@pytest.mark.parametrize('backend', ['numpy', 'numba'])
+def test_scratch_buffers_are_reused(backend):
+    kernels = load_backend(backend)
+    out = np.empty_like(x)
+    assert np.shares_memory(kernels['svi'](0.04, -0.3, 0.5, 0.2, 0.05, x, out), out)
+    work = np.empty((2, len(x)))
+    np.testing.assert_allclose(kernels['solve_grad'](0.3, 0.2, x, vT, work), kernels['solve_grad'](0.3, 0.2, x, vT),
+                               rtol=1e-12)